@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from .SQLiteDB import SQLiteDB
+
+
+class AsyncSQLiteDB:
+    """
+    asyncio front-end for SQLiteDB.
+    Writes are queued to a single background thread, which runs all the
+    writes waiting in the queue in one transaction (group commit),
+    so many small writes pay for a single fsync.
+    Reads run on a small thread pool, each thread with its own
+    read-only connection.
+
+    Usage:
+        db = AsyncSQLiteDB("cache.db")
+        await db.execute("CREATE TABLE IF NOT EXISTS t (a)")
+        await db.insert_into_many("t", [{"a": 1}, {"a": 2}])
+        rows = await db.fetch("SELECT a FROM t")
+        await db.close()
+    """
+
+    def __init__(
+        self,
+        dbfp: Path | str,
+        readers: int = 2,
+        profile: str = "balanced",
+        max_batch: int = 1000,
+        max_delay: float = 0.0,
+    ) -> None:
+        """
+        :param dbfp: The database file
+        :type dbfp: Path | str
+        :param readers: Number of reader threads
+        :type readers: int
+        :param profile: Performance profile (see SQLiteDB.PROFILES)
+        :type profile: str
+        :param max_batch: Maximum number of writes committed together
+        :type max_batch: int
+        :param max_delay: Seconds the writer waits for more writes before committing
+        :type max_delay: float
+        """
+        self.dbfp = Path(dbfp)
+        self.profile = profile
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.commits = 0
+        self.writes = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._local = threading.local()
+        self._reader_dbs: list[SQLiteDB] = list()
+        self._readers_lock = threading.Lock()
+        self._closed = False
+        # Start the writer first, so it's the one switching the db to WAL
+        ready = concurrent.futures.Future()
+        self._writer = threading.Thread(
+            target=self._writer_loop,
+            args=(ready,),
+            name="AsyncSQLiteDB-writer",
+            daemon=True,
+        )
+        self._writer.start()
+        ready.result()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="AsyncSQLiteDB-reader"
+        )
+
+    # Writer thread
+
+    def _writer_loop(self, ready: concurrent.futures.Future) -> None:
+        try:
+            db = SQLiteDB(self.dbfp, profile=self.profile)
+        except Exception as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(None)
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            batch = [job]
+            stop = self._fill_batch(batch)
+            self._run_batch(db, batch)
+            if stop:
+                break
+        db.close()
+
+    def _fill_batch(self, batch: list) -> bool:
+        """
+        Add to batch the writes waiting in the queue.
+        Return True if the close sentinel was found.
+        """
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    job = self._queue.get(timeout=timeout)
+                else:
+                    job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                return True
+            batch.append(job)
+        return False
+
+    def _run_batch(self, db: SQLiteDB, batch: list) -> None:
+        try:
+            results = self._run_jobs(db, batch)
+            db.commit()
+        except Exception as e:
+            # Never let an exception kill the writer thread:
+            # fail the writes of this group and keep serving the queue
+            logging.error(f"Group commit of {len(batch)} writes failed: {e}")
+            if db.con.in_transaction:
+                db.con.rollback()
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.commits += 1
+        self.writes += len(batch)
+        for fut, res, exc in results:
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(res)
+
+    @staticmethod
+    def _run_jobs(db: SQLiteDB, batch: list) -> list:
+        results = list()
+        db.commit()
+        db.cur.execute("BEGIN")
+        for fn, fut in batch:
+            # A savepoint per write, so a failing write
+            # doesn't roll back the others in the same group
+            db.cur.execute("SAVEPOINT job")
+            try:
+                res = fn(db)
+            except Exception as e:
+                if not db.con.in_transaction:
+                    # e.g. ON CONFLICT ROLLBACK rolled back the whole group
+                    fut.set_exception(e)
+                    raise Exception("A write rolled back the group transaction, "
+                                    "the other writes of the group were lost") from e
+                db.cur.execute("ROLLBACK TO job")
+                results.append((fut, None, e))
+            else:
+                results.append((fut, res, None))
+            db.cur.execute("RELEASE job")
+        return results
+
+    def _submit_write(self, fn: Callable[[SQLiteDB], Any]) -> asyncio.Future:
+        if self._closed:
+            raise Exception("AsyncSQLiteDB is closed")
+        if not self._writer.is_alive():
+            raise Exception("AsyncSQLiteDB writer thread is not running")
+        fut = concurrent.futures.Future()
+        self._queue.put((fn, fut))
+        return asyncio.wrap_future(fut)
+
+    # Reader threads
+
+    def _reader_db(self) -> SQLiteDB:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = SQLiteDB(self.dbfp, check_same_thread=False)
+            db.cur.execute("PRAGMA query_only = ON;")
+            self._local.db = db
+            with self._readers_lock:
+                self._reader_dbs.append(db)
+        return db
+
+    def _fetch(self, query: str, params: Any) -> list[sqlite3.Row]:
+        db = self._reader_db()
+        try:
+            return db.con.cursor().execute(query, params).fetchall()
+        finally:
+            db.con.rollback()
+
+    # Public API
+
+    async def execute(self, query: str, params: Any = ()) -> Optional[int]:
+        """
+        Run a write statement. Return the rowid of the last inserted row.
+        """
+        return await self._submit_write(
+            lambda db: db.con.cursor().execute(query, params).lastrowid
+        )
+
+    async def executemany(self, query: str, params: list) -> int:
+        """
+        Run a write statement for every element of params. Return the rowcount.
+        """
+        return await self._submit_write(
+            lambda db: db.con.cursor().executemany(query, params).rowcount
+        )
+
+    @staticmethod
+    def _check_crs(crs: Optional[str]) -> None:
+        if crs == "ROLLBACK":
+            raise Exception("crs='ROLLBACK' would roll back the other writes "
+                            "committed in the same group, use 'ABORT' instead")
+
+    async def insert_into(
+        self, table: str, data: dict[str, Any], crs: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        See SQLiteDB.insert_into. Return the rowid of the inserted row.
+        crs="ROLLBACK" is not supported: it would roll back the whole group.
+        """
+        AsyncSQLiteDB._check_crs(crs)
+        return await self._submit_write(
+            lambda db: db.insert_into(table, data, crs).lastrowid
+        )
+
+    async def insert_into_many(
+        self,
+        table: str,
+        data: list[dict[str, Any]],
+        crs: Optional[str] = None,
+        default_keys: dict[str, Any] = dict(),
+    ) -> int:
+        """
+        See SQLiteDB.insert_into_many. Return the rowcount.
+        crs="ROLLBACK" is not supported: it would roll back the whole group.
+        """
+        AsyncSQLiteDB._check_crs(crs)
+        return await self._submit_write(
+            lambda db: db.insert_into_many(
+                table, data, crs, default_keys=default_keys
+            ).rowcount
+        )
+
+    async def fetch(self, query: str, params: Any = ()) -> list[sqlite3.Row]:
+        """
+        Run a read-only query on a reader thread and return all its rows
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, self._fetch, query, params)
+
+    async def fetchone(self, query: str, params: Any = ()) -> Optional[sqlite3.Row]:
+        rows = await self.fetch(query, params)
+        return rows[0] if rows else None
+
+    async def close(self) -> None:
+        """
+        Wait for the pending writes to be committed and close all connections
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.join)
+        self._pool.shutdown(wait=True)
+        for db in self._reader_dbs:
+            db.close()
+        self._reader_dbs.clear()
@@ -2,17 +2,73 @@
 # Copyright 2023 Raffaele Mancuso
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import html
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from json import JSONDecodeError
+from typing import Iterable
+
+import pysqlite3
+import requests
+from pysqlite3 import IntegrityError
+from sklearn.feature_extraction.text import strip_accents_ascii
+
+from .GenniResponse import GenniResponse
+from .HTTPClient import HTTPClient
+from .RateLimiter import TokenBucket
+from .RetryPolicy import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+
 class GenniDB:
 
-    def __init__(self, dbfp):
-        self.session = requests.Session()
+    def __init__(self, dbfp, cache=True, commit_every=1000, commit_interval=10.0,
+                 retry=None, http=None):
+        """
+        :param dbfp: The database file
+        :param cache: Keep the names and project ids in the db in memory,
+                      so lookups don't need to query the db
+        :param commit_every: Commit after this many authors have been written
+        :param commit_interval: Commit if more than this many seconds
+                                have passed since the last commit
+        :param retry: The RetryPolicy shared by all the requests.
+                      If None, a new one is created
+        :param http: The HTTPClient. If None, a new one is created
+        """
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        # Only close the HTTP client if it's ours
+        self._own_http = http is None
+        self.http = http if http else HTTPClient(pool_size=8, timeout=20)
+        if retry is None:
+            retry_exceptions = (requests.RequestException,) + self.http.errors
+            retry = RetryPolicy(max_attempts=19, retry_exceptions=retry_exceptions)
+        self.retry = retry
+        # Error type -> count, filled by get_response()
+        self.errors = Counter()
+        self._errors_lock = threading.Lock()
         self.con = pysqlite3.connect(dbfp)
         self.con.row_factory = pysqlite3.Row
         self.cur = self.con.cursor()
         self.create_table()
+        self.cache = cache
+        # (first_in, last_in) -> genni.id
+        self._names = dict()
+        # proj2genni.project_id
+        self._projects = set()
+        if cache:
+            self.warm_cache()
 
     def __del__(self):
-        self.con.close()
+        self.close()
 
     def create_table(self):
         query = '''
@@ -46,6 +102,41 @@ class GenniDB:
         '''
         self.cur.execute(query)
 
+    def warm_cache(self):
+        """
+        Load the names and project ids in the db into memory.
+        Names are interned, since first names repeat a lot.
+        """
+        cur = self.con.cursor()
+        cur.row_factory = None
+        self._names = {
+            (sys.intern(first_in), sys.intern(last_in)): genni_id
+            for genni_id, first_in, last_in in
+            cur.execute("SELECT id, first_in, last_in FROM genni")
+        }
+        self._projects = {
+            project_id for (project_id,) in
+            cur.execute("SELECT project_id FROM proj2genni")
+        }
+        logging.info(f"Cached {len(self._names)} names "
+                     f"and {len(self._projects)} project ids")
+
+    def has_project(self, project_id):
+        if self.cache:
+            return project_id in self._projects
+        query = "SELECT project_id FROM proj2genni WHERE project_id=?"
+        return self.cur.execute(query, [project_id]).fetchone() is not None
+
+    def get_genni_id(self, first_in, last_in):
+        """
+        Return the genni.id of a (normalized) name, or None if not in the db
+        """
+        if self.cache:
+            return self._names.get((first_in, last_in))
+        query = "SELECT id AS genni_id FROM genni WHERE first_in=? AND last_in=?"
+        row = self.cur.execute(query, [first_in, last_in]).fetchone()
+        return row["genni_id"] if row else None
+
     @staticmethod
     def proc_name(s):
         s = html.unescape(s)
@@ -55,42 +146,125 @@ class GenniDB:
         #    s = " ".join(s)
         return s
 
+    @staticmethod
+    def normalize_name(s, unescape=True, fold_spaces=True):
+        """
+        Normalize a single name: HTML unescape, strip accents, fold whitespace.
+        Return the normalized name and whether accents were stripped.
+        """
+        if unescape:
+            s = html.unescape(s)
+        stripped = strip_accents_ascii(s)
+        strip_accents = stripped != s
+        if fold_spaces:
+            stripped = " ".join(stripped.split())
+        return stripped, strip_accents
+
+    @staticmethod
+    def normalize_names(names, unescape=True, fold_spaces=True):
+        """
+        Normalize many names at once (see normalize_name).
+        Every distinct name is normalized only once.
+        Missing names (None/NaN, or anything that is not a str)
+        are passed through unchanged, with flag False.
+        :param names: A pandas Series or a list of names
+        :return: The normalized names and the strip_accents flags,
+                 as two Series (with the index of `names`) or two lists
+        """
+        if hasattr(names, "unique") and hasattr(names, "map"):
+            # pandas Series
+            mapping = {
+                name: GenniDB.normalize_name(name, unescape, fold_spaces)
+                for name in names.unique() if isinstance(name, str)
+            }
+            keys = names.map({k: v[0] for k, v in mapping.items()})
+            keys = keys.where(keys.notna(), names)
+            flags = names.map({k: v[1] for k, v in mapping.items()})
+            flags = flags.fillna(False).astype(bool)
+            return keys, flags
+        mapping = dict()
+        keys = list()
+        flags = list()
+        for name in names:
+            if not isinstance(name, str):
+                keys.append(name)
+                flags.append(False)
+                continue
+            res = mapping.get(name)
+            if res is None:
+                res = mapping[name] = GenniDB.normalize_name(name, unescape, fold_spaces)
+            keys.append(res[0])
+            flags.append(res[1])
+        return keys, flags
+
     @staticmethod
     def build_url(given_name, surname):
         return f"http://abel.lis.illinois.edu/cgi-bin/ethnea/" \
                f"search.py?Fname={given_name}&Lname={surname}&format=json"
 
-    def get_response(self, url):
-        resp = None
+    def _count_error(self, error):
+        with self._errors_lock:
+            self.errors[error] += 1
 
-        for i in range(1,20):
-            try:
-                resp = self.session.get(url, stream=True, timeout=20)
-            except Exception as e:
-                logging.error("EXCEPTION:", e)
-                logging.error("Sleeping and then re-trying..")
-                time.sleep(10)
-            else:
-                break
+    @staticmethod
+    def parse_response(body: bytes) -> GenniResponse:
+        """
+        Parse the body of a Genni response.
+        Genni returns single-quoted JSON, so quotes are fixed on the raw bytes
+        and json.loads decodes them directly, without an intermediate str.
+        """
+        body = body.strip()
+        if b"'" in body:
+            body = body.replace(b"'", b'"')
+        return GenniResponse(json.loads(body), None)
+
+    def get_response(self, url, max_attempts=None, limiter=None):
+        """
+        Download and parse a Genni response.
+        Connection errors, timeouts and HTTP 429/5xx are retried
+        according to self.retry.
+        Errors are counted in self.errors.
+        :param url: The url to download
+        :param max_attempts: Maximum number of attempts.
+                             If None, the one of self.retry
+        :param limiter: A TokenBucket to take a token from before every attempt
+        """
+        def on_retry(reason):
+            self._count_error(reason)
+            logger.error(f"{reason} for url '{url}'")
+
+        def attempt():
+            if limiter is not None:
+                limiter.acquire()
+            return self.http.get(url)
 
-        if not resp:
+        try:
+            resp = self.retry.run(attempt, max_attempts=max_attempts,
+                                  on_retry=on_retry)
+        except self.retry.retry_exceptions:
+            resp = None
+        if resp is None or resp.status_code in self.retry.retry_statuses:
+            self._count_error("TooManyTrials")
             return GenniResponse(None, "TooManyTrials")
 
+        if resp.status_code != 200:
+            self._count_error(f"HTTP{resp.status_code}")
+            logger.error(f"HTTP {resp.status_code} for url '{url}'")
+            return GenniResponse(None, f"HTTP{resp.status_code}")
+
+        # Read the body once
         try:
-            resp_data = resp.raw.data.decode("utf8").replace("'", '"').strip()
-        except UnicodeDecodeError as e:
+            return GenniDB.parse_response(resp.content)
+        except UnicodeDecodeError:
+            self._count_error("UnicodeDecodeError")
             logger.error(f"UnicodeDecodeError for url '{url}'")
             return GenniResponse(None, "UnicodeDecodeError")
-
-        try:
-            resp_json = json.loads(resp_data)
-        except JSONDecodeError as e:
+        except JSONDecodeError:
+            self._count_error("JSONDecodeError")
             logger.error(f"JSONDecodeError for url '{url}'")
             return GenniResponse(None, "JSONDecodeError")
 
-        return GenniResponse(resp_json, None)
-
-    def insert(self, resp, first_in, last_in, project_id, strip_accents):
+    def insert(self, resp, first_in, last_in, project_id, strip_accents, commit=True):
 
         # Insert into genni table
         query = f"""
@@ -113,32 +287,36 @@ class GenniDB:
             }
 
         try:
-            self.cur.execute(query, d)
+            genni_id = self.cur.execute(query, d).lastrowid
         except IntegrityError as e:
             msg = "IntegrityError while inserting into db\n"
             msg += f"first_in={first_in}; last_in={last_in}; project_id={project_id}\n"
             msg += str(e)
             raise Exception(msg)
 
-        # Get max genni_id
-        query = "SELECT MAX(id) AS genni_id FROM genni"
-        genni_id = self.cur.execute(query).fetchone()["genni_id"]
+        if self.cache:
+            self._names[(sys.intern(first_in), sys.intern(last_in))] = genni_id
 
         # Insert into proj2genni table
+        self.link_project(project_id, genni_id)
+        if commit:
+            self.maybe_commit()
+        return genni_id
+
+    def link_project(self, project_id, genni_id):
         query = "INSERT INTO proj2genni (project_id, genni_id) VALUES (:project_id, :genni_id)"
         d = {
             "project_id": project_id,
             "genni_id": genni_id
         }
         self.cur.execute(query, d)
-        self.commit()
+        if self.cache:
+            self._projects.add(project_id)
 
     def scrape(self, first_in, last_in, project_id):
 
         # Check if this project_id is already in the db
-        query = "SELECT project_id FROM proj2genni WHERE project_id=?"
-        row = self.cur.execute(query, [project_id]).fetchone()
-        if row:
+        if self.has_project(project_id):
             return
 
         # Strip accents
@@ -149,17 +327,11 @@ class GenniDB:
         strip_accents = (first_in != first_in_old) or (last_in != last_in_old)
 
         # Check if name and surname are already in the db
-        query = "SELECT id AS genni_id, gender, ethnicity, error FROM genni WHERE first_in=? AND last_in=?"
-        row = self.cur.execute(query, [first_in, last_in]).fetchone()
-        if row:
+        genni_id = self.get_genni_id(first_in, last_in)
+        if genni_id is not None:
             logging.info(f"Value already present for project_id={project_id}")
-            query = "INSERT INTO proj2genni (project_id, genni_id) VALUES (:project_id, :genni_id)"
-            d = {
-                "project_id": project_id,
-                "genni_id": row["genni_id"]
-            }
-            self.cur.execute(query, d)
-            self.commit()
+            self.link_project(project_id, genni_id)
+            self.maybe_commit()
             return None
         else:
             #logging.info(f"Scraping first_in={first_in}, last_in={last_in}, project_id={project_id}")
@@ -171,12 +343,142 @@ class GenniDB:
         # Insert GenniResponse into the db
         if resp:
             self.insert(resp, first_in, last_in, project_id, strip_accents)
-            self.commit()
         return resp
 
+    def scrape_many(self,
+                    records: Iterable[tuple[str, str, int]],
+                    workers: int = 8,
+                    rate: float = 5.0,
+                    batch_size: int = 500) -> dict[str, int]:
+        """
+        Scrape many authors concurrently
+        :param records: (first_in, last_in, project_id) tuples
+        :type records: Iterable[tuple[str, str, int]]
+        :param workers: Number of threads downloading from Genni
+        :type workers: int
+        :param rate: Maximum requests per second, across all workers
+        :type rate: float
+        :param batch_size: Number of downloaded names written per transaction
+        :type batch_size: int
+        :return: Number of new projects, names already in the db, names downloaded
+                 and names that failed (not stored, retried on the next run)
+        """
+        # Skip projects already in the db
+        if self.cache:
+            done = set(self._projects)
+        else:
+            done = {row["project_id"] for row in
+                    self.cur.execute("SELECT project_id FROM proj2genni")}
+
+        firsts = list()
+        lasts = list()
+        project_ids = list()
+        for first_in, last_in, project_id in records:
+            if project_id in done:
+                continue
+            done.add(project_id)
+            firsts.append(first_in)
+            lasts.append(last_in)
+            project_ids.append(project_id)
+        nprojects = len(project_ids)
+
+        # Normalize every distinct name once,
+        # the same way scrape() does (accents only)
+        firsts, first_flags = GenniDB.normalize_names(
+            firsts, unescape=False, fold_spaces=False)
+        lasts, last_flags = GenniDB.normalize_names(
+            lasts, unescape=False, fold_spaces=False)
+
+        # Dedupe names up front
+        # (first_in, last_in) -> [strip_accents, project ids]
+        names = dict()
+        for key, first_flag, last_flag, project_id in zip(
+                zip(firsts, lasts), first_flags, last_flags, project_ids):
+            if key not in names:
+                names[key] = [first_flag or last_flag, []]
+            names[key][1].append(project_id)
+
+        # Names already in the db only need to be linked to the projects
+        misses = list()
+        ncached = 0
+        for key, (_, key_project_ids) in names.items():
+            genni_id = self.get_genni_id(*key)
+            if genni_id is not None:
+                for project_id in key_project_ids:
+                    self.link_project(project_id, genni_id)
+                ncached += 1
+            else:
+                misses.append(key)
+        self.commit()
+        logging.info(f"{nprojects} new projects, {len(names)} unique names, "
+                     f"{ncached} already in the db, {len(misses)} to download")
+
+        # Download the others
+        limiter = TokenBucket(rate)
+        self.http.ensure_pool_size(workers)
+
+        def fetch(key):
+            # Retries take a token too
+            url = GenniDB.build_url(*key)
+            return key, self.get_response(url, limiter=limiter)
+
+        ndownloaded = 0
+        nfailed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fetch, key) for key in misses]
+            try:
+                for fut in as_completed(futures):
+                    key, resp = fut.result()
+                    if resp.error is not None:
+                        # Already counted in self.errors by get_response().
+                        # Not stored, so the name is retried on the next run
+                        logging.error(f"Skipping first_in={key[0]}, last_in={key[1]}: "
+                                      f"{resp.error}")
+                        nfailed += 1
+                        continue
+                    strip_accents, key_project_ids = names[key]
+                    genni_id = self.insert(resp, key[0], key[1], key_project_ids[0],
+                                           strip_accents, commit=False)
+                    for project_id in key_project_ids[1:]:
+                        self.link_project(project_id, genni_id)
+                    ndownloaded += 1
+                    if ndownloaded % batch_size == 0:
+                        self.commit()
+                        logging.info(f"Downloaded {ndownloaded}/{len(misses)} names")
+            except BaseException:
+                # Don't wait for the queued downloads, and keep what was written
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.commit()
+                raise
+        self.commit()
+        metrics = self.retry.metrics
+        logging.info(f"{metrics.retries} retries, {metrics.failures} failures, "
+                     f"{metrics.wait_seconds:.1f} seconds spent waiting")
+        return {"projects": nprojects, "cached": ncached, "downloaded": ndownloaded,
+                "failed": nfailed}
+
+    def maybe_commit(self):
+        """
+        Count one write and commit if commit_every writes are pending
+        or commit_interval seconds have passed since the last commit
+        """
+        self._pending += 1
+        if self._pending >= self.commit_every or \
+           time.monotonic() - self._last_commit >= self.commit_interval:
+            self.commit()
+
     def commit(self):
         self.con.commit()
+        self._pending = 0
+        self._last_commit = time.monotonic()
 
     def close(self):
+        if self._own_http:
+            self.http.close()
+        if not self.con:
+            return
+        # Flush the pending writes
+        self.commit()
         self.con.close()
+        self.con = None
 
@@ -2,7 +2,15 @@
 # Copyright 2023 Raffaele Mancuso
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import sys
+from array import array
+from typing import Any, Iterable, Iterator, Optional
+
+
 class GenniResponse:
+    # No per-instance __dict__, we keep millions of these around
+    __slots__ = ("gender", "ethnicity", "first", "last", "error")
+
     def __init__(self, resp:Optional[dict], error:Optional[str]=None):
         if resp:
             self.gender = resp["Genni"]
@@ -20,6 +28,130 @@ class GenniResponse:
      #   self.ethnicity=ethnicity
      #   self.error=error
 
+    def to_dict(self) -> dict[str, Optional[str]]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.to_dict())
+
+
+class _Categories:
+    """
+    Maps a small set of repeated strings to integer codes.
+    None is code -1.
+    """
+    __slots__ = ("values", "codes")
+
+    def __init__(self):
+        self.values: list[str] = list()
+        self.codes: dict[str, int] = dict()
+
+    def code(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        c = self.codes.get(value)
+        if c is None:
+            c = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return c
+
+    def value(self, code: int) -> Optional[str]:
+        return None if code < 0 else self.values[code]
+
+
+class GenniResponseBatch:
+    """
+    Columnar storage for many GenniResponse.
+    gender, ethnicity and error are stored as integer codes into
+    a list of categories, first and last names as lists of interned strings.
+
+    Usage:
+        batch = GenniResponseBatch.from_responses(responses)
+        df = batch.to_dataframe()
+        db.insert_stream("table", batch.to_rows())
+    """
+
+    _CATEGORICAL = ("gender", "ethnicity", "error")
+
+    def __init__(self):
+        self.first: list[Optional[str]] = list()
+        self.last: list[Optional[str]] = list()
+        self._categories = {col: _Categories() for col in self._CATEGORICAL}
+        self._codes = {col: array("h") for col in self._CATEGORICAL}
+
+    @classmethod
+    def from_responses(cls, responses: Iterable[GenniResponse]) -> "GenniResponseBatch":
+        batch = cls()
+        batch.extend(responses)
+        return batch
+
+    def append(self, resp: GenniResponse) -> None:
+        self.first.append(sys.intern(resp.first) if resp.first else resp.first)
+        self.last.append(sys.intern(resp.last) if resp.last else resp.last)
+        for col in self._CATEGORICAL:
+            self._codes[col].append(self._categories[col].code(getattr(resp, col)))
+
+    def extend(self, responses: Iterable[GenniResponse]) -> None:
+        for resp in responses:
+            self.append(resp)
+
+    def __len__(self) -> int:
+        return len(self.first)
+
+    def __getitem__(self, i: int) -> GenniResponse:
+        resp = GenniResponse(None)
+        resp.first = self.first[i]
+        resp.last = self.last[i]
+        for col in self._CATEGORICAL:
+            setattr(resp, col, self._categories[col].value(self._codes[col][i]))
+        return resp
+
+    def __iter__(self) -> Iterator[GenniResponse]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def categories(self, col: str) -> list[str]:
+        return list(self._categories[col].values)
+
+    def codes(self, col: str) -> array:
+        return self._codes[col]
+
+    def to_dataframe(self) -> "pandas.DataFrame":
+        """
+        Convert to a pandas DataFrame, with categorical
+        gender, ethnicity and error columns built straight from the codes
+        """
+        import numpy as np
+        import pandas as pd
+
+        data: dict[str, Any] = {"first": self.first, "last": self.last}
+        for col in self._CATEGORICAL:
+            data[col] = pd.Categorical.from_codes(
+                np.frombuffer(self._codes[col], dtype=np.int16),
+                categories=self._categories[col].values,
+            )
+        return pd.DataFrame(data)
 
+    def to_rows(self, **extra: list) -> Iterator[dict[str, Any]]:
+        """
+        Yield one dict per response, with the column names of the genni table,
+        e.g. for SQLiteDB.insert_stream().
+        Extra columns can be given as keyword arguments of lists
+        as long as the batch (e.g. first_in=[...], last_in=[...]).
+        """
+        for col, values in extra.items():
+            assert len(values) == len(self), f"Column '{col}' has the wrong length"
+        gender = self._categories["gender"].value
+        ethnicity = self._categories["ethnicity"].value
+        error = self._categories["error"].value
+        for i in range(len(self)):
+            row = {
+                "ethnicity": ethnicity(self._codes["ethnicity"][i]),
+                "first_genni": self.first[i],
+                "gender": gender(self._codes["gender"][i]),
+                "last_genni": self.last[i],
+                "error": error(self._codes["error"][i]),
+            }
+            for col, values in extra.items():
+                row[col] = values[i]
+            yield row
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+from contextlib import contextmanager
+from typing import Any, Optional
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+
+class HTTPClient:
+    """
+    HTTP client shared by the network-bound classes (GenniDB, NominatimDB).
+    Connections are kept alive and reused, so requests after the first one
+    to a host skip the TCP/TLS handshake.
+
+    With requests, a single Session is shared by all threads, with an
+    HTTPAdapter keeping up to pool_size connections per host (urllib3's
+    connection pool is thread-safe, and only plain GETs are done here).
+    With http2=True a single httpx.Client is shared by all threads,
+    multiplexing the requests over HTTP/2 connections
+    (requires `pip install httpx[http2]`).
+
+    Usage:
+        http = HTTPClient(pool_size=8, max_per_host=4)
+        resp = http.get("https://nominatim.openstreetmap.org/search", params=...)
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        max_per_host: Optional[int] = None,
+        http2: bool = False,
+        compression: bool = True,
+        keep_alive: bool = True,
+        timeout: float = 30.0,
+        headers: Optional[dict[str, str]] = None,
+    ) -> None:
+        """
+        :param pool_size: Connections kept alive per host, shared by all
+                          the threads. Should be at least the number of
+                          worker threads (see ensure_pool_size())
+        :param max_per_host: Maximum concurrent requests to the same host,
+                             across all threads. None for no limit
+        :param http2: Use HTTP/2 through httpx
+        :param compression: Ask for compressed responses, with all the encodings
+                            that can be decoded (gzip, deflate, and br/zstd if
+                            brotli/zstandard are installed)
+        :param keep_alive: Keep connections open between requests
+        :param timeout: Default timeout of the requests, in seconds
+        :param headers: Headers sent with every request
+        """
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self.http2 = http2
+        self.timeout = timeout
+        self.headers = dict(headers) if headers else dict()
+        if compression:
+            self.headers.update(urllib3.util.make_headers(accept_encoding=True))
+        else:
+            self.headers["Accept-Encoding"] = "identity"
+        self.keep_alive = keep_alive
+        self._lock = threading.Lock()
+        self._session = None
+        self._host_limits: dict[str, threading.BoundedSemaphore] = dict()
+        self._client = None
+        if http2:
+            try:
+                import httpx
+            except ImportError:
+                raise Exception("http2=True requires httpx: pip install httpx[http2]")
+            # HTTP/2 forbids the Connection header,
+            # so without keep-alive no idle connection is kept in the pool
+            keepalive = pool_size if keep_alive else 0
+            limits = httpx.Limits(max_connections=None,
+                                  max_keepalive_connections=keepalive)
+            self._client = httpx.Client(http2=True, limits=limits,
+                                        headers=self.headers, timeout=timeout)
+            # Exceptions worth retrying
+            self.errors = (httpx.TransportError,)
+        else:
+            self.errors = (requests.ConnectionError, requests.Timeout,
+                           requests.exceptions.ChunkedEncodingError)
+
+    def session(self) -> Any:
+        """
+        The shared requests.Session, or the shared httpx.Client if http2=True
+        """
+        if self._client is not None:
+            return self._client
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.headers.update(self.headers)
+                    if not self.keep_alive:
+                        session.headers["Connection"] = "close"
+                    self._mount(session)
+                    self._session = session
+        return self._session
+
+    def _mount(self, session: requests.Session) -> None:
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def ensure_pool_size(self, workers: int) -> None:
+        """
+        Grow the connection pool to at least `workers` connections per host,
+        so that `workers` threads don't discard and reopen connections
+        """
+        with self._lock:
+            # HTTP/2 multiplexes concurrent requests over the same connections
+            if workers <= self.pool_size or self._client is not None:
+                return
+            self.pool_size = workers
+            if self._session is not None:
+                # Call before starting the workers: the connections
+                # of the old adapter are closed
+                old = self._session.get_adapter("https://")
+                self._mount(self._session)
+                old.close()
+
+    @contextmanager
+    def _host_slot(self, url: str):
+        if self.max_per_host is None:
+            yield
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            sem = self._host_limits.get(host)
+            if sem is None:
+                sem = self._host_limits[host] = \
+                    threading.BoundedSemaphore(self.max_per_host)
+        with sem:
+            yield
+
+    def get(self, url: str, params: Optional[dict] = None,
+            timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        GET `url`. Return a requests.Response, or an httpx.Response if http2=True
+        (both have status_code, headers, content, text and json()).
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self._host_slot(url):
+            return self.session().get(url, params=params, timeout=timeout, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+        if self._client is not None:
+            self._client.close()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from .Logger import Logger
+
+# Literals and repeated VALUES groups are replaced
+# so that queries differing only in their values share a template
+_RE_STRING = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_VALUES = re.compile(r"(\([?,\s]*\))(?:\s*,\s*\([?,\s]*\))+")
+_RE_SPACES = re.compile(r"\s+")
+
+
+def query_template(query: str) -> str:
+    """
+    Normalize a query into its template: collapse whitespace,
+    replace literals with ? and multi-row VALUES with a single row
+    """
+    q = _RE_SPACES.sub(" ", query).strip()
+    q = _RE_STRING.sub("?", q)
+    q = _RE_NUMBER.sub("?", q)
+    q = _RE_VALUES.sub(r"\1,...", q)
+    return q
+
+
+@dataclass
+class TemplateStats:
+    template: str
+    count: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    rows: int = 0
+    # Reservoir sample of latencies, to estimate percentiles in bounded memory
+    samples: list[float] = field(default_factory=list)
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return 0.0
+        s = sorted(self.samples)
+        return s[min(len(s) - 1, int(p / 100 * len(s)))]
+
+
+class QueryStats:
+    """
+    Per-template counts, latencies and rows touched
+    for the statements run through an InstrumentedConnection
+    """
+
+    def __init__(
+        self,
+        slow_seconds: Optional[float] = 0.1,
+        explain: bool = True,
+        logger: Optional[Logger] = None,
+        max_samples: int = 1000,
+    ) -> None:
+        """
+        :param slow_seconds: Statements slower than this are logged. None to disable
+        :type slow_seconds: Optional[float]
+        :param explain: Log the EXPLAIN QUERY PLAN of slow statements
+        :type explain: bool
+        :param logger: Where to log. If None, the logging module is used
+        :type logger: Optional[Logger]
+        :param max_samples: Latency samples kept per template for percentiles
+        :type max_samples: int
+        """
+        self.slow_seconds = slow_seconds
+        self.explain = explain
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.max_samples = max_samples
+        self.templates: dict[str, TemplateStats] = dict()
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        con: sqlite3.Connection,
+        query: str,
+        params: Any,
+        seconds: float,
+        rows: int,
+    ) -> None:
+        template = query_template(query)
+        with self._lock:
+            ts = self.templates.get(template)
+            if ts is None:
+                ts = self.templates[template] = TemplateStats(template)
+            ts.count += 1
+            ts.seconds += seconds
+            ts.max_seconds = max(ts.max_seconds, seconds)
+            if rows > 0:
+                ts.rows += rows
+            if len(ts.samples) < self.max_samples:
+                ts.samples.append(seconds)
+            else:
+                i = random.randrange(ts.count)
+                if i < self.max_samples:
+                    ts.samples[i] = seconds
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            self._log_slow(con, query, params, seconds)
+
+    def _log_slow(
+        self, con: sqlite3.Connection, query: str, params: Any, seconds: float
+    ) -> None:
+        query_1l = _RE_SPACES.sub(" ", query).strip()
+        msg = f"Slow query ({seconds * 1000:.1f} ms): {query_1l}"
+        if self.explain and params is not None:
+            try:
+                plan = con.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+            except sqlite3.Error as e:
+                msg += f"\nEXPLAIN QUERY PLAN failed: {e}"
+            else:
+                msg += "\nQuery plan:"
+                for row in plan:
+                    msg += f"\n  {row[-1]}"
+        self.logger.warning(msg)
+
+    def summary(self, top: int = 20, sort_by: str = "seconds") -> list[dict[str, Any]]:
+        """
+        Return the stats of the `top` templates, sorted by `sort_by`
+        ("seconds", "count", "max_seconds" or "rows")
+        """
+        with self._lock:
+            stats = sorted(
+                self.templates.values(),
+                key=lambda t: getattr(t, sort_by),
+                reverse=True,
+            )[:top]
+            return [
+                {
+                    "template": t.template,
+                    "count": t.count,
+                    "seconds": t.seconds,
+                    "mean_ms": t.seconds / t.count * 1000,
+                    "p50_ms": t.percentile(50) * 1000,
+                    "p95_ms": t.percentile(95) * 1000,
+                    "p99_ms": t.percentile(99) * 1000,
+                    "max_ms": t.max_seconds * 1000,
+                    "rows": t.rows,
+                }
+                for t in stats
+            ]
+
+    def log_summary(self, top: int = 20, sort_by: str = "seconds") -> None:
+        """
+        Log the summary of the `top` templates
+        """
+        msg = f"Query stats (top {top} by {sort_by}):"
+        for d in self.summary(top, sort_by):
+            msg += f"\n{d['count']:>9} calls {d['seconds']:>9.3f} s " \
+                   f"p50={d['p50_ms']:.2f} ms p95={d['p95_ms']:.2f} ms " \
+                   f"p99={d['p99_ms']:.2f} ms max={d['max_ms']:.2f} ms " \
+                   f"rows={d['rows']} | {d['template']}"
+        self.logger.info(msg)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.templates.clear()
+
+
+class InstrumentedCursor:
+    """
+    Proxy around sqlite3.Cursor timing execute() and executemany().
+    For statements returning rows (SELECT, RETURNING) SQLite does most
+    of the work while stepping through the results, so the time spent in
+    fetchone(), fetchmany(), fetchall() and iteration is added to the
+    statement, which is recorded with the number of rows fetched
+    once the results are exhausted (or the cursor is reused or closed).
+    """
+
+    def __init__(self, cur: sqlite3.Cursor, stats: QueryStats) -> None:
+        object.__setattr__(self, "_cur", cur)
+        object.__setattr__(self, "_stats", stats)
+        # [query, params, seconds, rows] of the statement being fetched
+        object.__setattr__(self, "_pending", None)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cur, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._cur, name, value)
+
+    def __del__(self) -> None:
+        if getattr(self, "_pending", None) is not None:
+            try:
+                self._finish()
+            except Exception:
+                # e.g. the connection was closed first
+                pass
+
+    def _finish(self) -> None:
+        pending = self._pending
+        if pending is None:
+            return
+        object.__setattr__(self, "_pending", None)
+        self._stats.record(self._cur.connection, *pending)
+
+    def _fetched(self, start: float, rows: int, done: bool) -> None:
+        pending = self._pending
+        if pending is None:
+            return
+        pending[2] += time.perf_counter() - start
+        pending[3] += rows
+        if done:
+            self._finish()
+
+    def execute(self, query: str, params: Any = ()) -> "InstrumentedCursor":
+        self._finish()
+        start = time.perf_counter()
+        self._cur.execute(query, params)
+        seconds = time.perf_counter() - start
+        if self._cur.description is not None:
+            # Recorded once the rows are fetched
+            object.__setattr__(self, "_pending", [query, params, seconds, 0])
+        else:
+            self._stats.record(
+                self._cur.connection, query, params, seconds, self._cur.rowcount
+            )
+        return self
+
+    def executemany(self, query: str, params: Any) -> "InstrumentedCursor":
+        self._finish()
+        start = time.perf_counter()
+        self._cur.executemany(query, params)
+        seconds = time.perf_counter() - start
+        # params may have been a consumed iterator, so don't EXPLAIN with it
+        self._stats.record(
+            self._cur.connection, query, None, seconds, self._cur.rowcount
+        )
+        return self
+
+    def fetchone(self) -> Any:
+        start = time.perf_counter()
+        row = self._cur.fetchone()
+        self._fetched(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> list:
+        size = self._cur.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = self._cur.fetchmany(size)
+        self._fetched(start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self) -> list:
+        start = time.perf_counter()
+        rows = self._cur.fetchall()
+        self._fetched(start, len(rows), True)
+        return rows
+
+    def __iter__(self) -> "InstrumentedCursor":
+        return self
+
+    def __next__(self) -> Any:
+        start = time.perf_counter()
+        try:
+            row = next(self._cur)
+        except StopIteration:
+            self._fetched(start, 0, True)
+            raise
+        self._fetched(start, 1, False)
+        return row
+
+    def close(self) -> None:
+        self._finish()
+        self._cur.close()
+
+
+class InstrumentedConnection:
+    """
+    Proxy around sqlite3.Connection whose cursors are InstrumentedCursor.
+    It is not a sqlite3.Connection: code that needs a real one
+    (pandas.read_sql, the target of Connection.backup, isinstance checks)
+    should be given `connection`, whose statements are not recorded.
+    """
+
+    def __init__(self, con: sqlite3.Connection, stats: QueryStats) -> None:
+        object.__setattr__(self, "_con", con)
+        object.__setattr__(self, "stats", stats)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        The wrapped sqlite3.Connection
+        """
+        return self._con
+
+    def __enter__(self) -> "InstrumentedConnection":
+        # Commit on success, roll back on exceptions, as sqlite3.Connection
+        self._con.__enter__()
+        return self
+
+    def __exit__(self, *exc_info) -> Optional[bool]:
+        return self._con.__exit__(*exc_info)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._con, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._con, name, value)
+
+    def cursor(self, *args, **kwargs) -> InstrumentedCursor:
+        return InstrumentedCursor(self._con.cursor(*args, **kwargs), self.stats)
+
+    def execute(self, query: str, params: Any = ()) -> InstrumentedCursor:
+        return self.cursor().execute(query, params)
+
+    def executemany(self, query: str, params: Any) -> InstrumentedCursor:
+        return self.cursor().executemany(query, params)
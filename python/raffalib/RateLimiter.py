@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    Allows on average `rate` acquisitions per second,
+    with bursts of up to `burst` acquisitions.
+    See: https://en.wikipedia.org/wiki/Token_bucket
+
+    Usage:
+        limiter = TokenBucket(rate=5)
+        limiter.acquire()  # blocks until a token is available
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        """
+        :param rate: Tokens added per second
+        :type rate: float
+        :param burst: Maximum tokens in the bucket
+        :type burst: int
+        """
+        assert rate > 0
+        assert burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """
+        Take `tokens` tokens if available, without blocking
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Block until `tokens` tokens are available and take them.
+        Return the seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+
+@dataclass
+class RetryMetrics:
+    calls: int = 0
+    attempts: int = 0
+    retries: int = 0
+    # Calls that still failed after the last attempt
+    failures: int = 0
+    # Seconds spent sleeping between attempts and waiting for the circuit breaker
+    wait_seconds: float = 0.0
+    circuit_opens: int = 0
+    # Reason (exception name or HTTP<status>) -> number of failed attempts
+    reasons: Counter = field(default_factory=Counter)
+
+
+class CircuitBreaker:
+    """
+    Shared by all the workers talking to the same service.
+    After `failure_threshold` consecutive failures the circuit opens
+    and every worker pauses for `cooldown` seconds. Then the circuit is
+    half-open: a single caller is let through to probe the service,
+    while the others keep waiting until the probe succeeds (the circuit
+    closes) or fails (the circuit opens again).
+    See: https://martinfowler.com/bliki/CircuitBreaker.html
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 60.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._open_until = 0.0
+        # Thread probing the service while half-open, and when to give up on it
+        self._probe: Optional[int] = None
+        self._probe_deadline = 0.0
+        self._cond = threading.Condition()
+        self.opens = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.state != CircuitBreaker.CLOSED
+
+    def wait(self) -> float:
+        """
+        Block while the circuit is open, or half-open with another
+        caller probing the service. Return the seconds waited.
+        """
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self.state == CircuitBreaker.CLOSED:
+                    break
+                if now < self._open_until:
+                    self._cond.wait(self._open_until - now)
+                    continue
+                if self.state == CircuitBreaker.OPEN or now >= self._probe_deadline:
+                    # Cooldown over (or the probe never reported back):
+                    # this caller probes the service
+                    self.state = CircuitBreaker.HALF_OPEN
+                    self._probe = threading.get_ident()
+                    self._probe_deadline = now + self.cooldown
+                    break
+                if self._probe == threading.get_ident():
+                    break
+                self._cond.wait(self._probe_deadline - now)
+        return time.monotonic() - start
+
+    def _open(self, seconds: float) -> None:
+        self.state = CircuitBreaker.OPEN
+        self._probe = None
+        self._open_until = max(self._open_until, time.monotonic() + seconds)
+        self._cond.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Pause all workers for `seconds` (e.g. from a Retry-After header),
+        then let a single probe through
+        """
+        with self._cond:
+            self._open(seconds)
+
+    def success(self) -> None:
+        with self._cond:
+            self._failures = 0
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.state = CircuitBreaker.CLOSED
+                self._probe = None
+                self._cond.notify_all()
+
+    def failure(self) -> bool:
+        """
+        Record a failure. Return True if this failure opened the circuit.
+        """
+        with self._cond:
+            if self.state == CircuitBreaker.HALF_OPEN and \
+               self._probe == threading.get_ident():
+                # The probe failed
+                self._failures = 0
+                self._open(self.cooldown)
+                self.opens += 1
+                return True
+            self._failures += 1
+            if self._failures >= self.failure_threshold and \
+               self.state == CircuitBreaker.CLOSED:
+                self._failures = 0
+                self._open(self.cooldown)
+                self.opens += 1
+                return True
+            return False
+
+    def abandon(self) -> None:
+        """
+        The calling thread stops without reporting success or failure
+        (e.g. a non-retryable exception): if it was probing,
+        let another caller probe
+        """
+        with self._cond:
+            if self.state == CircuitBreaker.HALF_OPEN and \
+               self._probe == threading.get_ident():
+                self.state = CircuitBreaker.OPEN
+                self._probe = None
+                self._cond.notify_all()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds to wait according to a Retry-After header,
+    which is either a number of seconds or an HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        dt = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (dt - now).total_seconds())
+
+
+class RetryPolicy:
+    """
+    Retry with full-jitter exponential backoff, honoring Retry-After,
+    with a circuit breaker shared by all the threads using the policy.
+    See: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+
+    Usage:
+        policy = RetryPolicy(retry_exceptions=(requests.RequestException,))
+        resp = policy.run(lambda: session.get(url, timeout=20))
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 10,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 60.0,
+        retry_exceptions: tuple[type[BaseException], ...] = (),
+        retry_statuses: tuple[int, ...] = (429, 500, 502, 503, 504),
+        breaker: Optional[CircuitBreaker] = None,
+        max_retry_after: float = 600.0,
+    ) -> None:
+        """
+        :param max_attempts: Maximum attempts per call
+        :param backoff_base: Attempt n sleeps up to backoff_base * 2^n seconds
+        :param backoff_cap: Maximum backoff sleep in seconds
+        :param retry_exceptions: Exceptions that are retried
+        :param retry_statuses: HTTP status codes that are retried
+                               (for results with a `status_code` attribute)
+        :param breaker: The circuit breaker. If None, a new one is created
+        :param max_retry_after: Cap on the Retry-After waits, in seconds
+        """
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retry_exceptions = retry_exceptions
+        self.retry_statuses = retry_statuses
+        self.breaker = breaker if breaker else CircuitBreaker()
+        self.max_retry_after = max_retry_after
+        self.metrics = RetryMetrics()
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt: int) -> float:
+        max_sleep = min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+        return random.uniform(0, max_sleep)
+
+    def _retry_after(
+        self, result: Any = None, exc: Optional[BaseException] = None
+    ) -> Optional[float]:
+        if exc is not None:
+            # e.g. geopy's GeocoderRateLimited
+            retry_after = getattr(exc, "retry_after", None)
+            return None if retry_after is None else float(retry_after)
+        headers = getattr(result, "headers", None)
+        if headers is None:
+            return None
+        return parse_retry_after(headers.get("Retry-After"))
+
+    def run(
+        self,
+        fn: Callable[[], Any],
+        max_attempts: Optional[int] = None,
+        on_retry: Optional[Callable[[str], None]] = None,
+    ) -> Any:
+        """
+        Call fn() until it succeeds.
+        If all attempts fail, the last exception is raised,
+        or the last result is returned if fn() returned a retryable status.
+        :param fn: The function to call
+        :param max_attempts: Override the policy's max_attempts
+        :param on_retry: Called with the reason (exception name or HTTP<status>)
+                         of every failed attempt
+        """
+        max_attempts = max_attempts or self.max_attempts
+        with self._lock:
+            self.metrics.calls += 1
+        for attempt in range(max_attempts):
+            waited = self.breaker.wait()
+            exc = result = None
+            try:
+                result = fn()
+            except self.retry_exceptions as e:
+                exc = e
+                reason = type(e).__name__
+            except BaseException:
+                self.breaker.abandon()
+                raise
+            else:
+                status = getattr(result, "status_code", None)
+                if status not in self.retry_statuses:
+                    self.breaker.success()
+                    with self._lock:
+                        self.metrics.attempts += 1
+                        self.metrics.wait_seconds += waited
+                    return result
+                reason = f"HTTP{status}"
+            if on_retry:
+                on_retry(reason)
+            retry_after = self._retry_after(result, exc)
+            if retry_after is not None:
+                # The server told us how long to wait: pause everybody
+                self.breaker.pause(min(retry_after, self.max_retry_after))
+            opened = self.breaker.failure()
+            last = attempt == max_attempts - 1
+            with self._lock:
+                self.metrics.attempts += 1
+                self.metrics.wait_seconds += waited
+                self.metrics.reasons[reason] += 1
+                if opened:
+                    self.metrics.circuit_opens += 1
+                if last:
+                    self.metrics.failures += 1
+                else:
+                    self.metrics.retries += 1
+            if opened:
+                logging.warning(f"Circuit opened after repeated failures ({reason}), "
+                                f"pausing for {self.breaker.cooldown} seconds")
+            if last:
+                break
+            sleep_time = self.backoff(attempt)
+            logging.info(f"{reason}, sleeping {sleep_time:.2f} seconds then retrying "
+                         f"(attempt {attempt + 2}/{max_attempts})")
+            time.sleep(sleep_time)
+            with self._lock:
+                self.metrics.wait_seconds += sleep_time
+        if exc is not None:
+            raise exc
+        return result
@@ -2,32 +2,188 @@
 # Copyright 2023 Raffaele Mancuso
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import functools
+import itertools
 import logging
 import sqlite3
+import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from .Logger import Logger
+from .QueryStats import InstrumentedConnection, QueryStats
+
+# Performance profiles for SQLiteDB.set_profile()
+# Pragmas are applied in this order. journal_mode must come first because
+# the other pragmas' meaning (and safety) depends on it.
+# See: https://www.sqlite.org/pragma.html
+# See: https://www.sqlite.org/wal.html
+PROFILES: dict[str, dict[str, Any]] = {
+    # WAL lets readers run concurrently with the writer,
+    # FULL syncs the WAL on every commit
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+    },
+    # WAL + NORMAL is durable against application crashes,
+    # the last commits may roll back on power loss
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+    # For one-off loads into a database nobody else is using.
+    # A crash during the load can corrupt the database.
+    "bulk-load": {
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "cache_size": -512000,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+@dataclass
+class BulkInsertResult:
+    rows: int
+    chunks: int
+    seconds: float
+    # Only filled by upsert_many(..., returning=True)
+    rowids: Optional[list[int]] = None
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+@functools.lru_cache(maxsize=1024)
+def insert_query(
+    table: str, cols: tuple[str, ...], crs: Optional[str] = None, named: bool = True
+) -> str:
+    """
+    Build (and cache) the text of an INSERT statement.
+    Returning the very same string for the same arguments
+    lets sqlite3's statement cache hit.
+    :param table: The table to insert into
+    :param cols: The columns to insert
+    :param crs: Conflict resolution strategy (e.g. "IGNORE")
+    :param named: Use named (:col) placeholders instead of positional (?) ones
+    """
+    assert crs in [None, "ROLLBACK", "ABORT", "FAIL", "IGNORE", "REPLACE"]
+    col_names = ",".join(cols)
+    if named:
+        col_phs = ",".join([":" + x for x in cols])
+    else:
+        col_phs = ",".join(["?"] * len(cols))
+    or_statement = ("OR " + crs + " ") if crs else ""
+    return f"INSERT {or_statement}INTO {table} ({col_names}) VALUES ({col_phs});"
+
+
+@functools.lru_cache(maxsize=1024)
+def upsert_query(
+    table: str,
+    cols: tuple[str, ...],
+    conflict_cols: tuple[str, ...],
+    update_cols: tuple[str, ...],
+    nrows: int = 1,
+    returning: bool = False,
+) -> str:
+    """
+    Build (and cache) the text of a multi-row
+    INSERT ... ON CONFLICT DO UPDATE statement.
+    See: https://www.sqlite.org/lang_upsert.html
+    :param table: The table to insert into
+    :param cols: The columns to insert
+    :param conflict_cols: The conflict target (columns of a UNIQUE index)
+    :param update_cols: The columns to update on conflict. If empty, DO NOTHING
+    :param nrows: The number of rows in the VALUES clause
+    :param returning: Add a RETURNING rowid clause
+    """
+    col_names = ",".join(cols)
+    row_phs = "(" + ",".join(["?"] * len(cols)) + ")"
+    values = ",".join([row_phs] * nrows)
+    target = ",".join(conflict_cols)
+    if update_cols:
+        sets = ",".join([f"{c}=excluded.{c}" for c in update_cols])
+        action = f"DO UPDATE SET {sets}"
+    else:
+        action = "DO NOTHING"
+    query = f"INSERT INTO {table} ({col_names}) VALUES {values} " \
+            f"ON CONFLICT({target}) {action}"
+    if returning:
+        query += " RETURNING rowid"
+    return query + ";"
+
+
+def arrow_array(
+    col: Iterable, typ: Optional["pyarrow.DataType"] = None
+) -> "pyarrow.Array":
+    """
+    Convert a column of SQLite values to a pyarrow.Array of type `typ`
+    (inferred if None). SQLite columns can mix types (e.g. '' in an INTEGER
+    column): if the values don't fit and `typ` is None or a string type,
+    they are converted to strings.
+    """
+    import pyarrow as pa
+
+    try:
+        return pa.array(col, type=typ)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if typ is not None and not pa.types.is_string(typ):
+            raise
+    return pa.array(
+        [v if v is None or isinstance(v, str) else str(v) for v in col],
+        type=pa.string(),
+    )
+
+
+def arrow_promote(a: "pyarrow.DataType", b: "pyarrow.DataType") -> "pyarrow.DataType":
+    """
+    The narrowest of null, int64, float64 and string holding both types
+    """
+    import pyarrow as pa
+
+    if a == b or pa.types.is_null(b):
+        return a
+    if pa.types.is_null(a):
+        return b
+    if {a, b} == {pa.int64(), pa.float64()}:
+        return pa.float64()
+    return pa.string()
 
 
 class SQLiteDB:
     def __init__(
-        self, dbfp: Path | str, commit_on_close: bool = False
+        self,
+        dbfp: Path | str,
+        commit_on_close: bool = False,
+        profile: Optional[str] = None,
+        cached_statements: int = 128,
+        check_same_thread: bool = True,
     ) -> None:
         self.commit_on_close = commit_on_close
+        self.profile = None
         self.dbfp = Path(dbfp)
         self.dbfp.parent.mkdir(parents=True, exist_ok=True)
-        self.con = sqlite3.Connection(self.dbfp)
+        self.con = sqlite3.Connection(
+            self.dbfp,
+            cached_statements=cached_statements,
+            check_same_thread=check_same_thread,
+        )
         self.con.row_factory = sqlite3.Row
         self.cur = self.con.cursor()
         self.set_foreign_keys(True)
         # For litestream
         self.cur.execute("PRAGMA busy_timeout = 5000;")
-        # self.cur.execute("PRAGMA journal_mode=WAL;")
-        # commit before turning synchronous to normal
-        # otherwise sqlite3 fails with
-        # OperationalError: Safety level may not be changed inside a transaction
-        # self.con.commit()
-        # self.cur.execute("PRAGMA synchronous = NORMAL;")
-        # self.cur.execute("PRAGMA wal_autocheckpoint = 0;")
+        if profile:
+            self.set_profile(profile)
 
     def __del__(self) -> None:
         self.close()
@@ -64,6 +220,159 @@ class SQLiteDB:
         self.cur.execute(f"PRAGMA foreign_keys = {fks};")
         assert self.get_foreign_keys() == fk
 
+    def set_profile(self, profile: str) -> dict[str, Any]:
+        """
+        Apply one of the performance profiles in PROFILES
+        :param profile: The profile name ("safe", "balanced" or "bulk-load")
+        :type profile: str
+        :return: The pragma values actually in effect after applying the profile
+        """
+        if profile not in PROFILES:
+            raise ValueError(
+                f"Unknown profile '{profile}'. Valid profiles: {list(PROFILES)}"
+            )
+        # commit before changing journal mode and synchronous level
+        # otherwise sqlite3 fails with
+        # OperationalError: Safety level may not be changed inside a transaction
+        self.commit()
+        for pragma, value in PROFILES[profile].items():
+            self.cur.execute(f"PRAGMA {pragma} = {value};")
+        self.profile = profile
+        pragmas = self.get_pragmas()
+        if pragmas["journal_mode"].upper() != PROFILES[profile]["journal_mode"]:
+            # e.g. in-memory databases can't use WAL
+            logging.warning(
+                f"Requested journal_mode={PROFILES[profile]['journal_mode']} "
+                f"but got journal_mode={pragmas['journal_mode']}"
+            )
+        return pragmas
+
+    def get_pragmas(self) -> dict[str, Any]:
+        """
+        Return the current value of the pragmas set by the performance profiles
+        """
+        pragmas = dict()
+        for pragma in list(PROFILES["safe"]) + ["wal_autocheckpoint"]:
+            row = self.cur.execute(f"PRAGMA {pragma};").fetchone()
+            # Some pragmas (e.g. mmap_size on in-memory databases) return no rows
+            pragmas[pragma] = row[0] if row else None
+        return pragmas
+
+    def backup_to(
+        self,
+        fp: Path | str,
+        pages_per_step: int = 1024,
+        progress: Optional[Callable[[int, int, int], None]] = None,
+        sleep: float = 0.01,
+    ) -> Path:
+        """
+        Take a consistent copy of the live database with the online backup API.
+        The copy is done `pages_per_step` pages at a time and the database
+        is unlocked between steps, so writers are never blocked for long.
+        Pending changes are committed first, so they are in the copy.
+        See: https://www.sqlite.org/backup.html
+        :param fp: The destination file. Overwritten if it exists
+        :type fp: Path | str
+        :param pages_per_step: Pages copied per step. -1 to copy everything in one step
+        :type pages_per_step: int
+        :param progress: Called after every step as progress(status, remaining, total)
+        :type progress: Optional[Callable[[int, int, int], None]]
+        :param sleep: Seconds to sleep between steps
+        :type sleep: float
+        :return: The destination file
+        """
+        fp = Path(fp)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        # The backup can't step past our own write lock
+        self.commit()
+        dst = sqlite3.connect(fp)
+        try:
+            self.con.backup(dst, pages=pages_per_step, progress=progress, sleep=sleep)
+        finally:
+            dst.close()
+        return fp
+
+    def vacuum_into(self, fp: Path | str) -> Path:
+        """
+        Write a compacted copy of the database to `fp` with VACUUM INTO.
+        Unlike backup_to, it runs in a single read transaction,
+        which doesn't block writers under WAL.
+        See: https://www.sqlite.org/lang_vacuum.html#vacuuminto
+        :param fp: The destination file. Must not exist
+        :type fp: Path | str
+        :return: The destination file
+        """
+        fp = Path(fp)
+        if fp.exists():
+            raise FileExistsError(f"'{fp}' already exists")
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        self.commit()
+        self.con.cursor().execute("VACUUM INTO ?", [str(fp)])
+        return fp
+
+    def wal_checkpoint(self, mode: str = "PASSIVE") -> dict[str, int]:
+        """
+        Run a WAL checkpoint.
+        PASSIVE checkpoints as many frames as possible without waiting
+        for readers or writers, so it can be called often to keep the WAL short.
+        See: https://www.sqlite.org/pragma.html#pragma_wal_checkpoint
+        :param mode: "PASSIVE", "FULL", "RESTART" or "TRUNCATE"
+        :type mode: str
+        :return: busy flag, frames in the WAL and frames checkpointed
+        """
+        assert mode in ["PASSIVE", "FULL", "RESTART", "TRUNCATE"]
+        row = self.cur.execute(f"PRAGMA wal_checkpoint({mode});").fetchone()
+        return {"busy": row[0], "log": row[1], "checkpointed": row[2]}
+
+    def set_wal_autocheckpoint(self, pages: int) -> int:
+        """
+        Set after how many WAL pages SQLite checkpoints automatically.
+        0 disables automatic checkpoints (e.g. when litestream or
+        wal_checkpoint() take care of them)
+        """
+        self.cur.execute(f"PRAGMA wal_autocheckpoint = {int(pages)};")
+        return self.cur.execute("PRAGMA wal_autocheckpoint;").fetchone()[0]
+
+    def enable_instrumentation(
+        self,
+        slow_seconds: Optional[float] = 0.1,
+        explain: bool = True,
+        logger: Optional[Logger] = None,
+    ) -> QueryStats:
+        """
+        Start recording per-statement-template counts, latencies and rows touched
+        for the statements run through self.con and self.cur.
+        self.con becomes an InstrumentedConnection proxy: it works as a context
+        manager, but it is not a sqlite3.Connection, so pass self.con.connection
+        to code that needs a real one (e.g. pandas.read_sql, or as the target
+        of a backup). Statements run through it are not recorded.
+        :param slow_seconds: Statements slower than this are logged
+                             with their EXPLAIN QUERY PLAN. None to disable
+        :type slow_seconds: Optional[float]
+        :param explain: Log the query plan of slow statements
+        :type explain: bool
+        :param logger: Where to log. If None, the logging module is used
+        :type logger: Optional[Logger]
+        :return: The QueryStats object collecting the stats
+        """
+        if isinstance(self.con, InstrumentedConnection):
+            return self.con.stats
+        stats = QueryStats(slow_seconds=slow_seconds, explain=explain, logger=logger)
+        self.con = InstrumentedConnection(self.con, stats)
+        self.cur = self.con.cursor()
+        return stats
+
+    def disable_instrumentation(self) -> Optional[QueryStats]:
+        """
+        Stop recording stats. Return the QueryStats collected so far
+        """
+        if not isinstance(self.con, InstrumentedConnection):
+            return None
+        stats = self.con.stats
+        self.con = self.con.connection
+        self.cur = self.con.cursor()
+        return stats
+
     def get_max_id(self, table: str, col: str = "id") -> int:
         # self.logger.warning("Using get_max_id. Are you sure?")
         query = f"SELECT MAX({col}) AS max_id FROM {table}"
@@ -72,12 +381,7 @@ class SQLiteDB:
     def insert_into(
         self, table: str, data: dict[str, Any], crs: Optional[str] = None
     ) -> sqlite3.Cursor:
-        assert crs in [None, "ROLLBACK", "ABORT", "FAIL", "IGNORE", "REPLACE"]
-        col_names = ",".join(list(data.keys()))
-        col_phs = [":" + x for x in list(data.keys())]
-        col_phs = ",".join(col_phs)
-        or_statement = ("OR " + crs) if crs else ""
-        query = f"INSERT {or_statement} INTO {table} ({col_names}) VALUES ({col_phs});"
+        query = insert_query(table, tuple(data.keys()), crs)
         return self.con.cursor().execute(query, data)
 
     def insert_into_many(
@@ -95,7 +399,8 @@ class SQLiteDB:
                 if defkey not in data[i].keys():
                     data[i][defkey] = default_keys[defkey]
         # Get keys and check
-        keys = set(data[0].keys())
+        cols = tuple(data[0].keys())
+        keys = set(cols)
         for i, d in enumerate(data[1:]):
             if set(d.keys()) != keys:
                 a = set(d.keys()) - keys
@@ -106,11 +411,7 @@ class SQLiteDB:
                 raise Exception(
                     "Passed a list of dicts with different keys from each other"
                 )
-        col_names = ",".join(keys)
-        col_phs = [":" + x for x in keys]
-        col_phs = ",".join(col_phs)
-        or_statement = ("OR " + crs + " ") if crs else ""
-        query = f"INSERT {or_statement}INTO {table} ({col_names}) VALUES ({col_phs});"
+        query = insert_query(table, cols, crs)
         if not debug:
             return self.con.cursor().executemany(query, data)
         logging.info("\ninsert_into_many debugging")
@@ -120,6 +421,179 @@ class SQLiteDB:
             self.con.cursor().execute(query, datum)
         return
 
+    @staticmethod
+    def _chunk_columns(
+        chunk: list[dict[str, Any]], default_keys: dict[str, Any], offset: int = 0
+    ) -> tuple[str, ...]:
+        """
+        Decide the columns of a chunk of rows from its first row,
+        and check that no other row has extra keys.
+        Missing keys are caught when the row values are extracted.
+        """
+        cols = list(chunk[0].keys())
+        cols += [k for k in default_keys if k not in chunk[0]]
+        colset = set(cols)
+        for i, row in enumerate(chunk):
+            if not row.keys() <= colset:
+                msg = f"Row {offset + i} has keys '{row.keys() - colset}' " \
+                      f"not present in row {offset}"
+                logging.error(msg)
+                raise Exception(
+                    "Passed an iterable of dicts with different keys from each other"
+                )
+        return tuple(cols)
+
+    def insert_stream(
+        self,
+        table: str,
+        rows: Iterable[dict[str, Any]],
+        chunk_size: int = 10000,
+        crs: Optional[str] = None,
+        default_keys: dict[str, Any] = dict(),
+    ) -> BulkInsertResult:
+        """
+        Insert rows from any iterable (e.g. a generator) in chunks,
+        committing every chunk in its own transaction.
+        Rows are not materialized nor modified.
+        :param table: The table to insert into
+        :type table: str
+        :param rows: The rows to insert, as dicts column->value
+        :type rows: Iterable[dict[str, Any]]
+        :param chunk_size: Number of rows per transaction
+        :type chunk_size: int
+        :param crs: Conflict resolution strategy (e.g. "IGNORE")
+        :type crs: Optional[str]
+        :param default_keys: Values for columns missing from a row
+        :type default_keys: dict[str, Any]
+        :return: Number of rows and chunks inserted and time spent
+        """
+        assert crs in [None, "ROLLBACK", "ABORT", "FAIL", "IGNORE", "REPLACE"]
+        assert chunk_size > 0
+        # Commit whatever is pending, so every chunk is its own transaction
+        self.commit()
+        it = iter(rows)
+        nrows = nchunks = 0
+        start = time.perf_counter()
+        while True:
+            chunk = list(itertools.islice(it, chunk_size))
+            if not chunk:
+                break
+            cols = self._chunk_columns(chunk, default_keys, nrows)
+            query = insert_query(table, cols, crs, named=False)
+            params = (
+                tuple(
+                    row[k] if k in row else default_keys[k]
+                    for k in cols
+                )
+                for row in chunk
+            )
+            cur = self.con.cursor()
+            cur.execute("BEGIN")
+            try:
+                cur.executemany(query, params)
+            except Exception:
+                self.con.rollback()
+                raise
+            self.commit()
+            nrows += len(chunk)
+            nchunks += 1
+        seconds = time.perf_counter() - start
+        result = BulkInsertResult(rows=nrows, chunks=nchunks, seconds=seconds)
+        logging.info(
+            f"Inserted {nrows} rows into {table} in {nchunks} chunks, "
+            f"{seconds:.2f} seconds ({result.rows_per_second:.0f} rows/s)"
+        )
+        return result
+
+    def upsert_many(
+        self,
+        table: str,
+        rows: Iterable[dict[str, Any]],
+        conflict_cols: list[str],
+        update_cols: Optional[list[str]] = None,
+        chunk_size: int = 1000,
+        returning: bool = False,
+        default_keys: dict[str, Any] = dict(),
+    ) -> BulkInsertResult:
+        """
+        Insert rows, updating the existing ones that conflict on `conflict_cols`.
+        Every chunk is sent as a single multi-row statement
+        and committed in its own transaction.
+        :param table: The table to insert into
+        :type table: str
+        :param rows: The rows to upsert, as dicts column->value
+        :type rows: Iterable[dict[str, Any]]
+        :param conflict_cols: The conflict target. Must match a UNIQUE index
+        :type conflict_cols: list[str]
+        :param update_cols: The columns to update on conflict.
+                            If None, all the inserted columns but the conflict target.
+                            If empty, conflicting rows are left untouched
+        :type update_cols: Optional[list[str]]
+        :param chunk_size: Number of rows per statement
+        :type chunk_size: int
+        :param returning: Return the rowids of the inserted/updated rows
+                          (rows skipped by DO NOTHING are not returned)
+        :type returning: bool
+        :param default_keys: Values for columns missing from a row
+        :type default_keys: dict[str, Any]
+        :return: Number of rows and chunks processed, time spent and rowids
+        """
+        assert chunk_size > 0
+        self.commit()
+        it = iter(rows)
+        nrows = nchunks = 0
+        rowids = list() if returning else None
+        start = time.perf_counter()
+        while True:
+            chunk = list(itertools.islice(it, chunk_size))
+            if not chunk:
+                break
+            cols = self._chunk_columns(chunk, default_keys, nrows)
+            if update_cols is None:
+                upd = tuple(c for c in cols if c not in conflict_cols)
+            else:
+                upd = tuple(update_cols)
+            cur = self.con.cursor()
+            cur.row_factory = None
+            cur.execute("BEGIN")
+            try:
+                # Stay below the limit of bound variables per statement
+                step = max(1, self.max_variables() // len(cols))
+                for i in range(0, len(chunk), step):
+                    sub = chunk[i : i + step]
+                    query = upsert_query(
+                        table, cols, tuple(conflict_cols), upd, len(sub), returning
+                    )
+                    params = [
+                        row[k] if k in row else default_keys[k]
+                        for row in sub
+                        for k in cols
+                    ]
+                    cur.execute(query, params)
+                    if returning:
+                        rowids.extend(r[0] for r in cur.fetchall())
+            except Exception:
+                self.con.rollback()
+                raise
+            self.commit()
+            nrows += len(chunk)
+            nchunks += 1
+        seconds = time.perf_counter() - start
+        return BulkInsertResult(
+            rows=nrows, chunks=nchunks, seconds=seconds, rowids=rowids
+        )
+
+    def max_variables(self) -> int:
+        """
+        Maximum number of bound variables per statement
+        (SQLITE_MAX_VARIABLE_NUMBER: 999 before SQLite 3.32, 32766 since,
+        unless SQLite was compiled with another value)
+        """
+        # Connection.getlimit() is available since Python 3.11
+        if hasattr(self.con, "getlimit"):
+            return self.con.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        return 999 if sqlite3.sqlite_version_info < (3, 32, 0) else 32766
+
     def get_tables(self) -> list[str]:
         query = """
         SELECT
@@ -160,3 +634,206 @@ class SQLiteDB:
     def drop_all_tables(self):
         for table in self.get_tables():
             self.drop_table(table)
+
+    def iter_batches(
+        self, query: str, params: Any = (), batch_size: int = 100000
+    ) -> Iterator[tuple[list[str], list[tuple]]]:
+        """
+        Run a query and yield its result in batches of columns
+        (not rows), without creating a sqlite3.Row per record.
+        :param query: The query to run
+        :type query: str
+        :param params: The query parameters
+        :param batch_size: Number of rows per batch
+        :type batch_size: int
+        :return: An iterator of (column names, list of columns)
+        """
+        cur = self.con.cursor()
+        # Plain tuples are much cheaper than sqlite3.Row
+        cur.row_factory = None
+        cur.arraysize = batch_size
+        cur.execute(query, params)
+        names = [d[0] for d in cur.description]
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            yield names, list(zip(*rows))
+
+    def arrow_schema(self, query: str, params: Any = ()) -> "pyarrow.Schema":
+        """
+        Infer the Arrow schema of the result of a query from the SQLite types
+        of all its values, not only the first rows: a column NULL in the first
+        rows still gets the type of its later values, a column mixing integers
+        and reals becomes float64 and any other mix becomes string.
+        Runs the query once more.
+        :param query: The query
+        :type query: str
+        :param params: The query parameters
+        :return: The schema
+        """
+        import pyarrow as pa
+
+        query = query.strip().rstrip(";")
+        cur = self.con.cursor()
+        names = [d[0] for d in cur.execute(query, params).description]
+        cur.close()
+        # Positional column names, so duplicate or quoted names don't matter
+        cols = [f"c{i}" for i in range(len(names))]
+        types = ",".join(f"group_concat(DISTINCT typeof({c}))" for c in cols)
+        row = self.con.cursor().execute(
+            f"WITH q({','.join(cols)}) AS ({query}) SELECT {types} FROM q", params
+        ).fetchone()
+        sqlite_types = {"integer": pa.int64(), "real": pa.float64(),
+                        "text": pa.string(), "blob": pa.binary()}
+        fields = list()
+        for name, ts in zip(names, row):
+            typ = pa.null()
+            for t in set(ts.split(",")) - {"null"} if ts else set():
+                typ = arrow_promote(typ, sqlite_types[t])
+            fields.append(pa.field(name, typ))
+        return pa.schema(fields)
+
+    def iter_arrow_batches(
+        self,
+        query: str,
+        params: Any = (),
+        batch_size: int = 100000,
+        schema: Optional["pyarrow.Schema"] = None,
+    ) -> Iterator["pyarrow.RecordBatch"]:
+        """
+        Like iter_batches(), but yield pyarrow.RecordBatch objects.
+        If schema is given, all the batches have it. Otherwise the types are
+        inferred batch by batch and only ever widen (null to any type,
+        int64 to float64, any mix to string, see arrow_promote()), so a batch
+        can have a narrower schema than the later ones: cast the batches to
+        the schema of the last one to get a single schema.
+        """
+        import pyarrow as pa
+
+        types = None
+        for names, cols in self.iter_batches(query, params, batch_size):
+            if schema is not None:
+                arrays = [arrow_array(col, field.type)
+                          for col, field in zip(cols, schema)]
+                yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+                continue
+            if types is None:
+                types = [pa.null()] * len(names)
+            arrays = list()
+            for i, col in enumerate(cols):
+                arr = arrow_array(col)
+                typ = arrow_promote(types[i], arr.type)
+                if arr.type != typ:
+                    arr = arrow_array(col, typ)
+                types[i] = typ
+                arrays.append(arr)
+            yield pa.RecordBatch.from_arrays(arrays, names=names)
+
+    def read_query(
+        self,
+        query: str,
+        params: Any = (),
+        batch_size: int = 100000,
+        schema: Optional["pyarrow.Schema"] = None,
+    ) -> "pandas.DataFrame":
+        """
+        Read the result of a query into a pandas DataFrame, in batches.
+        Uses pyarrow for the column buffers if it's installed.
+        :param schema: The Arrow schema. If None, inferred while reading
+                       (see iter_arrow_batches)
+        """
+        import pandas as pd
+
+        try:
+            import pyarrow as pa
+        except ImportError:
+            frames = [
+                pd.DataFrame(dict(zip(names, cols)))
+                for names, cols in self.iter_batches(query, params, batch_size)
+            ]
+            if not frames:
+                return pd.DataFrame()
+            return pd.concat(frames, ignore_index=True)
+        batches = list(self.iter_arrow_batches(query, params, batch_size, schema))
+        if not batches:
+            return pd.DataFrame()
+        # The types only widen, so the last batch has the widest schema
+        schema = batches[-1].schema
+        tables = [pa.Table.from_batches([b]).cast(schema) for b in batches]
+        return pa.concat_tables(tables).to_pandas()
+
+    def read_table(
+        self,
+        table: str,
+        columns: Optional[list[str]] = None,
+        batch_size: int = 100000,
+        schema: Optional["pyarrow.Schema"] = None,
+    ) -> "pandas.DataFrame":
+        """
+        Read a whole table into a pandas DataFrame (see read_query)
+        """
+        cols = ",".join(columns) if columns else "*"
+        return self.read_query(f"SELECT {cols} FROM {table}",
+                               batch_size=batch_size, schema=schema)
+
+    def export_query(
+        self,
+        query: str,
+        fp: Path | str,
+        params: Any = (),
+        fmt: Optional[str] = None,
+        batch_size: int = 100000,
+        schema: Optional["pyarrow.Schema"] = None,
+    ) -> int:
+        """
+        Stream the result of a query to a Parquet or Feather file
+        one batch at a time, without loading it all in memory.
+        :param query: The query to run
+        :param fp: The output file
+        :param params: The query parameters
+        :param fmt: "parquet" or "feather". If None, guessed from the file extension
+        :param batch_size: Number of rows per batch
+        :param schema: The Arrow schema. If None, inferred from the whole result
+                       with arrow_schema(), which runs the query once more:
+                       a file has a single schema, so the types can't widen
+                       while writing
+        :return: The number of rows written
+        """
+        import pyarrow as pa
+
+        if schema is None:
+            schema = self.arrow_schema(query, params)
+
+        fp = Path(fp)
+        if fmt is None:
+            fmt = "parquet" if fp.suffix == ".parquet" else "feather"
+        assert fmt in ["parquet", "feather"]
+        nrows = 0
+        writer = None
+        try:
+            for batch in self.iter_arrow_batches(query, params, batch_size, schema):
+                if writer is None:
+                    if fmt == "parquet":
+                        import pyarrow.parquet as pq
+
+                        writer = pq.ParquetWriter(fp, batch.schema)
+                    else:
+                        writer = pa.ipc.new_file(fp, batch.schema)
+                if fmt == "parquet":
+                    writer.write_batch(batch)
+                else:
+                    writer.write(batch)
+                nrows += batch.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        return nrows
+
+    def export_table(
+        self, table: str, fp: Path | str, fmt: Optional[str] = None, **kwargs
+    ) -> int:
+        """
+        Stream a whole table to a Parquet or Feather file (see export_query)
+        """
+        return self.export_query(f"SELECT * FROM {table}", fp, fmt=fmt, **kwargs)
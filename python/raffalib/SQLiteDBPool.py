@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import contextlib
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+from .SQLiteDB import SQLiteDB
+
+
+@dataclass
+class PoolStats:
+    readers_open: int = 0
+    reader_checkouts: int = 0
+    writer_checkouts: int = 0
+    # Checkouts that had to wait for a connection to be returned
+    waits: int = 0
+    wait_seconds: float = 0.0
+
+
+class SQLiteDBPool:
+    """
+    Pool of SQLiteDB connections to the same database file
+    that can be shared between threads.
+    There is a single writer connection, serialized by a lock,
+    and up to `max_readers` read-only connections.
+    The database is put in WAL mode so readers don't block the writer
+    and vice versa.
+
+    Usage:
+        pool = SQLiteDBPool("cache.db", max_readers=8)
+        with pool.reader() as db:
+            db.cur.execute("SELECT ...")
+        with pool.writer() as db:
+            db.insert_into("table", {...})
+    """
+
+    def __init__(
+        self,
+        dbfp: Path | str,
+        max_readers: int = 4,
+        profile: str = "balanced",
+        timeout: float = 30.0,
+    ) -> None:
+        """
+        :param dbfp: The database file
+        :type dbfp: Path | str
+        :param max_readers: Maximum number of read-only connections
+        :type max_readers: int
+        :param profile: Performance profile (see SQLiteDB.PROFILES). Must use WAL.
+        :type profile: str
+        :param timeout: Seconds to wait for a free reader before raising queue.Empty
+        :type timeout: float
+        """
+        assert max_readers > 0
+        self.dbfp = Path(dbfp)
+        self.max_readers = max_readers
+        self.profile = profile
+        self.timeout = timeout
+        self.stats = PoolStats()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._readers: queue.LifoQueue[SQLiteDB] = queue.LifoQueue()
+        self._all_readers: list[SQLiteDB] = list()
+        # The writer is created first so it's the one switching the db to WAL
+        self._writer = self._connect()
+        self._closed = False
+
+    def _connect(self) -> SQLiteDB:
+        return SQLiteDB(self.dbfp, profile=self.profile, check_same_thread=False)
+
+    def _new_reader(self) -> SQLiteDB:
+        db = self._connect()
+        db.cur.execute("PRAGMA query_only = ON;")
+        self._all_readers.append(db)
+        self.stats.readers_open += 1
+        return db
+
+    def _get_reader(self) -> SQLiteDB:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all_readers) < self.max_readers:
+                return self._new_reader()
+        start = time.perf_counter()
+        db = self._readers.get(timeout=self.timeout)
+        with self._lock:
+            self.stats.waits += 1
+            self.stats.wait_seconds += time.perf_counter() - start
+        return db
+
+    @contextlib.contextmanager
+    def reader(self) -> Iterator[SQLiteDB]:
+        """
+        Check out a read-only connection
+        """
+        if self._closed:
+            raise Exception("Pool is closed")
+        db = self._get_reader()
+        with self._lock:
+            self.stats.reader_checkouts += 1
+        try:
+            yield db
+        finally:
+            # Don't keep a read transaction (and its WAL snapshot) open
+            db.con.rollback()
+            self._readers.put(db)
+
+    @contextlib.contextmanager
+    def writer(self) -> Iterator[SQLiteDB]:
+        """
+        Check out the writer connection.
+        Commits on success, rolls back if an exception is raised.
+        """
+        if self._closed:
+            raise Exception("Pool is closed")
+        start = time.perf_counter()
+        if not self._write_lock.acquire(blocking=False):
+            if not self._write_lock.acquire(timeout=self.timeout):
+                raise TimeoutError("Timed out waiting for the writer connection")
+            with self._lock:
+                self.stats.waits += 1
+                self.stats.wait_seconds += time.perf_counter() - start
+        with self._lock:
+            self.stats.writer_checkouts += 1
+        try:
+            yield self._writer
+        except BaseException:
+            self._writer.con.rollback()
+            raise
+        else:
+            self._writer.commit()
+        finally:
+            self._write_lock.release()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        with self._write_lock:
+            self._writer.close()
+        for db in self._all_readers:
+            db.close()
+        self._all_readers.clear()
+        self.stats.readers_open = 0
+
+    def __enter__(self) -> "SQLiteDBPool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
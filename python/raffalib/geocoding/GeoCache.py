@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from ..SQLiteDB import SQLiteDB
+from .RawPayloads import LazyPayload, RawPayloads
+
+# Columns of the shared `geocoding` table, besides id
+# Both GeoCodingDB (geopy) and NominatimDB store Nominatim results,
+# so they share the schema and the cache
+GEOCODING_COLUMNS = {
+    "input": "TEXT NOT NULL",
+    "query_key": "TEXT",
+    "provider": "TEXT",
+    "status_code": "INTEGER",
+    "nres": "INTEGER",
+    "error": "TEXT",
+    "addresstype": "TEXT",
+    "bounding_box_x1": "REAL",
+    "bounding_box_y1": "REAL",
+    "bounding_box_x2": "REAL",
+    "bounding_box_y2": "REAL",
+    "class": "TEXT",
+    "display_name": "TEXT",
+    "importance": "REAL",
+    "lat": "REAL",
+    "licence": "TEXT",
+    "lon": "REAL",
+    "name": "TEXT",
+    "osm_id": "INTEGER",
+    "osm_type": "TEXT",
+    "place_id": "INTEGER",
+    "place_rank": "INTEGER",
+    "type": "TEXT",
+}
+
+
+@dataclass
+class CachePolicy:
+    # Bump to invalidate all the results cached by a provider
+    version: int = 1
+    # Seconds after which results are downloaded again. None for never
+    ttl: Optional[float] = None
+    # Seconds after which queries with no results (or an error) are retried
+    negative_ttl: float = 30 * 24 * 3600
+
+
+@dataclass
+class _Entry:
+    ids: list[int]
+    provider: str
+    timestamp: float
+    negative: bool = field(default=False)
+
+
+class GeoCache:
+    """
+    Geocoding cache shared by the geocoding front-ends.
+    Results are stored in the `geocoding` table, one row per result,
+    and the `queries` table, one row per canonical query key
+    (also for queries with no results, i.e. the negative cache).
+    An in-memory LRU tier sits on top of the SQLite tier.
+    Entries are valid according to the CachePolicy of the provider
+    that stored them, so front-ends reuse each other's results.
+    Fields without a column in `geocoding` are only kept
+    if the full responses are stored in `raw`.
+    """
+
+    def __init__(
+        self,
+        db: SQLiteDB,
+        provider: str,
+        policies: Optional[dict[str, CachePolicy]] = None,
+        lru_size: int = 100000,
+        raw: Optional[RawPayloads] = None,
+    ) -> None:
+        """
+        :param db: The database
+        :param provider: Name of the provider storing results through this cache
+        :param policies: Provider name -> CachePolicy.
+                         Providers not in the dict use the default CachePolicy
+        :param lru_size: Maximum number of queries kept in memory
+        :param raw: Where to store the full raw responses. None to not store them
+        """
+        self.db = db
+        self.raw = raw
+        self.provider = provider
+        self.policies = policies if policies else dict()
+        self.lru_size = lru_size
+        self._lru: OrderedDict[str, _Entry] = OrderedDict()
+        self.hits = self.lru_hits = self.misses = 0
+
+    def policy(self, provider: Optional[str] = None) -> CachePolicy:
+        provider = provider or self.provider
+        if provider not in self.policies:
+            self.policies[provider] = CachePolicy()
+        return self.policies[provider]
+
+    def ini_db(self) -> None:
+        """
+        Create the shared tables, and add the missing columns
+        to tables created by older versions of GeoCodingDB and NominatimDB
+        """
+        cur = self.db.con.cursor()
+        cols = ",\n".join([f"{k} {v}" for k, v in GEOCODING_COLUMNS.items()])
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS geocoding (
+            id INTEGER PRIMARY KEY NOT NULL,
+            {cols}
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS queries
+        (
+            query_key TEXT PRIMARY KEY NOT NULL,
+            input TEXT NOT NULL,
+            status_code INTEGER NOT NULL,
+            nres INTEGER,
+            timestamp REAL NOT NULL,
+            provider TEXT,
+            version INTEGER
+        )
+        """)
+        self._add_missing_columns("geocoding", GEOCODING_COLUMNS)
+        self._add_missing_columns("queries", {"provider": "TEXT", "version": "INTEGER"})
+        cur.execute("CREATE INDEX IF NOT EXISTS geocoding_input ON geocoding(input)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS geocoding_query_key ON geocoding(query_key)"
+        )
+        if self.raw is not None:
+            self.raw.ini_db()
+
+    def _add_missing_columns(self, table: str, columns: dict[str, str]) -> None:
+        cur = self.db.con.cursor()
+        existing = {row["name"] for row in cur.execute(f"PRAGMA table_info({table})")}
+        for col, decl in columns.items():
+            if col not in existing:
+                # ALTER TABLE can't add NOT NULL columns without a default
+                decl = decl.replace("NOT NULL", "")
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+
+    def _valid(self, entry: _Entry) -> bool:
+        policy = self.policy(entry.provider)
+        ttl = policy.negative_ttl if entry.negative else policy.ttl
+        return ttl is None or time.time() - entry.timestamp < ttl
+
+    def _remember(self, key: str, entry: _Entry) -> None:
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def lookup(self, key: str, legacy_input: Optional[str] = None) -> Optional[list[int]]:
+        """
+        Return the geocoding ids cached for a query key,
+        an empty list if the query is in the negative cache,
+        None if the query must be (re-)downloaded
+        :param key: The canonical query key
+        :param legacy_input: Input text of the query, to find results
+                             cached before query keys were introduced
+        """
+        return self.lookup_many({key: legacy_input})[key]
+
+    def lookup_many(
+        self, keys: dict[str, Optional[str]]
+    ) -> dict[str, Optional[list[int]]]:
+        """
+        Like lookup(), for many queries at once.
+        The queries not in memory are resolved with a few batched SELECTs
+        instead of one round-trip per query.
+        :param keys: Canonical query key -> legacy input text (or None)
+        :return: Canonical query key -> ids, [] or None as in lookup()
+        """
+        res = dict()
+        todo = list()
+        for key in keys:
+            entry = self._lru.get(key)
+            if entry is not None:
+                if self._valid(entry):
+                    self._lru.move_to_end(key)
+                    self.hits += 1
+                    self.lru_hits += 1
+                    res[key] = entry.ids
+                    continue
+                del self._lru[key]
+            todo.append(key)
+        if not todo:
+            return res
+        rows = self._select_in("""
+        SELECT query_key, status_code, nres, timestamp, provider, version
+        FROM queries WHERE query_key IN ({})
+        """, todo)
+        rows = {row["query_key"]: row for row in rows}
+        positive = [key for key, row in rows.items()
+                    if row["status_code"] == 200 and row["nres"]]
+        ids = {key: [] for key in positive}
+        query = """
+        SELECT query_key, id FROM geocoding WHERE query_key IN ({}) ORDER BY id
+        """
+        for row in self._select_in(query, positive):
+            ids[row["query_key"]].append(row["id"])
+        # Results cached before query keys were introduced
+        legacy = {keys[key]: key for key in todo
+                  if key not in rows and keys[key] is not None}
+        legacy_ids = dict()
+        query = """
+        SELECT input, id FROM geocoding
+        WHERE input IN ({}) AND query_key IS NULL ORDER BY id
+        """
+        for row in self._select_in(query, list(legacy)):
+            legacy_ids.setdefault(legacy[row["input"]], []).append(row["id"])
+        for key in todo:
+            row = rows.get(key)
+            if row is None:
+                res[key] = legacy_ids.get(key)
+            else:
+                provider = row["provider"] or self.provider
+                entry = _Entry(ids.get(key, []), provider, row["timestamp"],
+                               key not in ids)
+                if (row["version"] or 1) != self.policy(provider).version or \
+                   not self._valid(entry):
+                    res[key] = None
+                else:
+                    self._remember(key, entry)
+                    res[key] = entry.ids
+            if res[key] is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return res
+
+    def _select_in(self, query: str, values: list, chunk_size: int = 500):
+        """
+        Run `query` with its IN ({}) list filled with `values`,
+        in chunks to stay below SQLite's limit of bound variables
+        """
+        cur = self.db.con.cursor()
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i + chunk_size]
+            phs = ",".join(["?"] * len(chunk))
+            yield from cur.execute(query.format(phs), chunk).fetchall()
+
+    @staticmethod
+    def flatten_bbox(loc: dict[str, Any]) -> dict[str, Any]:
+        """
+        Replace Nominatim's `boundingbox` list with the bounding_box_* columns
+        """
+        if "boundingbox" in loc:
+            loc["bounding_box_x1"] = loc["boundingbox"][0]
+            loc["bounding_box_y1"] = loc["boundingbox"][1]
+            loc["bounding_box_x2"] = loc["boundingbox"][2]
+            loc["bounding_box_y2"] = loc["boundingbox"][3]
+            del loc["boundingbox"]
+        return loc
+
+    def store(
+        self,
+        key: str,
+        input_text: str,
+        status_code: int,
+        locs: list[dict[str, Any]],
+    ) -> list[int]:
+        """
+        Store a provider response. Does not commit.
+        :param key: The canonical query key
+        :param input_text: The query as text
+        :param status_code: HTTP status code of the response
+        :param locs: The results, as returned by Nominatim
+        :return: The new geocoding ids
+        """
+        nres = len(locs) if status_code == 200 else None
+        now = time.time()
+        cur = self.db.con.cursor()
+        # Replace the rows of a previous download of the same query
+        cur.execute("DELETE FROM geocoding WHERE query_key=?", [key])
+        self.db.insert_into("queries", {
+            "query_key": key,
+            "input": input_text,
+            "status_code": status_code,
+            "nres": nres,
+            "timestamp": now,
+            "provider": self.provider,
+            "version": self.policy().version,
+        }, crs="REPLACE")
+        if self.raw is not None:
+            self.raw.put(key, locs)
+        ids = list()
+        if locs:
+            loclist = list()
+            for loc in locs:
+                loc = GeoCache.flatten_bbox(dict(loc))
+                loc["input"] = input_text
+                loc["query_key"] = key
+                loc["provider"] = self.provider
+                loc["status_code"] = status_code
+                loc["nres"] = nres
+                loc.setdefault("osm_type", "")
+                loc.setdefault("osm_id", "")
+                # Same keys for every row, and no fields without a column
+                loclist.append({col: loc.get(col) for col in GEOCODING_COLUMNS})
+            self.db.insert_into_many("geocoding", loclist)
+            query = "SELECT id FROM geocoding WHERE query_key=?"
+            ids = [r["id"] for r in cur.execute(query, [key])]
+        self._remember(key, _Entry(ids, self.provider, now, not ids))
+        return ids
+
+    def raw_payload(self, key: str) -> Optional[LazyPayload]:
+        """
+        The full raw response stored for a query key,
+        None if it was not stored (or raw responses are not stored)
+        """
+        if self.raw is None:
+            return None
+        return self.raw.get(key)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import math
+
+# Mean Earth radius in km
+EARTH_RADIUS = 6371.0088
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Great-circle distance in km between two points given in degrees
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GeoIndex:
+    """
+    R*Tree spatial index over a geocoding table, for SQLiteDB subclasses.
+    The index is kept in sync with the table by triggers.
+
+    Nominatim bounding boxes are [min_lat, max_lat, min_lon, max_lon], so:
+    bounding_box_x1 = min lat, bounding_box_y1 = max lat,
+    bounding_box_x2 = min lon, bounding_box_y2 = max lon.
+    Rows without a bounding box are indexed by their lat/lon point.
+    See: https://www.sqlite.org/rtree.html
+    """
+
+    geo_table = "geocoding"
+
+    @property
+    def rtree_table(self) -> str:
+        return self.geo_table + "_rtree"
+
+    def ini_rtree(self) -> None:
+        """
+        Create the R*Tree, its triggers, and index the rows already in the table
+        """
+        t = self.geo_table
+        rt = self.rtree_table
+        # The box of a row: its bounding box, or its point
+        box = """
+            COALESCE({p}.bounding_box_x1, {p}.lat),
+            COALESCE({p}.bounding_box_y1, {p}.lat),
+            COALESCE({p}.bounding_box_x2, {p}.lon),
+            COALESCE({p}.bounding_box_y2, {p}.lon)
+        """
+        has_box = """
+            COALESCE({p}.bounding_box_x1, {p}.lat) IS NOT NULL AND
+            COALESCE({p}.bounding_box_x2, {p}.lon) IS NOT NULL
+        """
+        cur = self.con.cursor()
+        cur.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {rt}
+        USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {rt}_insert AFTER INSERT ON {t}
+        WHEN {has_box.format(p="NEW")}
+        BEGIN
+            INSERT OR REPLACE INTO {rt} VALUES (NEW.id, {box.format(p="NEW")});
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {rt}_delete AFTER DELETE ON {t}
+        BEGIN
+            DELETE FROM {rt} WHERE id = OLD.id;
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {rt}_update AFTER UPDATE ON {t}
+        BEGIN
+            DELETE FROM {rt} WHERE id = OLD.id;
+            INSERT INTO {rt}
+            SELECT NEW.id, {box.format(p="NEW")}
+            WHERE {has_box.format(p="NEW")};
+        END
+        """)
+        # Backfill, only the first time
+        if cur.execute(f"SELECT COUNT(*) FROM {rt}").fetchone()[0] == 0:
+            cur.execute(f"""
+            INSERT INTO {rt}
+            SELECT {t}.id, {box.format(p=t)} FROM {t}
+            WHERE {has_box.format(p=t)}
+            """)
+
+    def bbox_intersects(
+        self, min_lat: float, max_lat: float, min_lon: float, max_lon: float
+    ) -> list[int]:
+        """
+        Ids of the rows whose bounding box intersects the given one
+        """
+        query = f"""
+        SELECT id FROM {self.rtree_table}
+        WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?
+        """
+        rows = self.con.cursor().execute(query, [min_lat, max_lat, min_lon, max_lon])
+        return [row["id"] for row in rows]
+
+    def bbox_contains_point(self, lat: float, lon: float) -> list[int]:
+        """
+        Ids of the rows whose bounding box contains the given point
+        """
+        return self.bbox_intersects(lat, lat, lon, lon)
+
+    def points_in_bbox(
+        self, min_lat: float, max_lat: float, min_lon: float, max_lon: float
+    ) -> list[int]:
+        """
+        Ids of the rows whose lat/lon point falls in the given bounding box
+        """
+        query = f"""
+        SELECT g.id FROM {self.rtree_table} AS r
+        JOIN {self.geo_table} AS g ON g.id = r.id
+        WHERE r.max_lat >= :min_lat AND r.min_lat <= :max_lat AND
+              r.max_lon >= :min_lon AND r.min_lon <= :max_lon AND
+              g.lat BETWEEN :min_lat AND :max_lat AND
+              g.lon BETWEEN :min_lon AND :max_lon
+        """
+        d = {"min_lat": min_lat, "max_lat": max_lat,
+             "min_lon": min_lon, "max_lon": max_lon}
+        return [row["id"] for row in self.con.cursor().execute(query, d)]
+
+    def nearest(
+        self, lat: float, lon: float, k: int = 1, start_radius: float = 0.01
+    ) -> list[tuple[int, float]]:
+        """
+        The k rows whose lat/lon point is nearest to the given point.
+        Searches the R*Tree in windows of growing size, which wrap around
+        the antimeridian.
+        :param lat: Latitude in degrees
+        :param lon: Longitude in degrees
+        :param k: Number of rows to return
+        :param start_radius: Half-side in degrees of the first search window
+        :return: (id, distance in km) tuples, nearest first
+        """
+        query = f"""
+        SELECT g.id, g.lat, g.lon FROM {self.rtree_table} AS r
+        JOIN {self.geo_table} AS g ON g.id = r.id
+        WHERE r.max_lat >= ? AND r.min_lat <= ? AND
+              r.max_lon >= ? AND r.min_lon <= ? AND
+              g.lat IS NOT NULL AND g.lon IS NOT NULL
+        """
+        radius = start_radius
+        while True:
+            dists = dict()
+            for min_lon, max_lon in _lon_ranges(lon - radius, lon + radius):
+                params = [lat - radius, lat + radius, min_lon, max_lon]
+                for row in self.con.cursor().execute(query, params):
+                    dists[row["id"]] = haversine(lat, lon, row["lat"], row["lon"])
+            res = sorted(dists.items(), key=lambda x: x[1])
+            if radius >= 180:
+                return res[:k]
+            # Every point outside the window is at least this far away:
+            # either its latitude differs by more than radius, or its
+            # longitude (around the antimeridian too) does
+            edge_lat = min(90.0, abs(lat) + radius)
+            cos_lat = math.sqrt(math.cos(math.radians(lat)) *
+                                math.cos(math.radians(edge_lat)))
+            guaranteed = min(
+                EARTH_RADIUS * math.radians(radius),
+                2 * EARTH_RADIUS *
+                math.asin(min(1.0, cos_lat * math.sin(math.radians(radius) / 2))),
+            )
+            if len(res) >= k and res[k - 1][1] <= guaranteed:
+                return res[:k]
+            radius *= 4
+
+
+def _lon_ranges(min_lon: float, max_lon: float) -> list[tuple[float, float]]:
+    """
+    Split a longitude range crossing the antimeridian
+    into ranges within [-180, 180]
+    """
+    if max_lon - min_lon >= 360:
+        return [(-180.0, 180.0)]
+    if min_lon < -180:
+        return [(min_lon + 360, 180.0), (-180.0, max_lon)]
+    if max_lon > 180:
+        return [(min_lon, 180.0), (-180.0, max_lon - 360)]
+    return [(min_lon, max_lon)]
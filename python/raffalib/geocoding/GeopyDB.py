@@ -4,23 +4,29 @@
 
 import datetime
 import hashlib
-import random
-import time
 from pathlib import Path
+from typing import Optional
 import logging
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
+from geopy.exc import GeocoderRateLimited, GeocoderTimedOut, GeocoderUnavailable
 from geopy.geocoders import Nominatim
 
-from .SQLiteDB import SQLiteDB
+from ..SQLiteDB import SQLiteDB
+from ..RateLimiter import TokenBucket
+from ..RetryPolicy import RetryPolicy
+from .GeoIndex import GeoIndex
+from .GeoCache import CachePolicy, GeoCache
+from .RawPayloads import LazyPayload, RawPayloads
+from .NominatimDB import NominatimQuery
 
 @dataclass
 class GeoCodingID():
     ids:list[int]
     downloaded:bool
 
-class GeoCodingDB(SQLiteDB):
+class GeoCodingDB(GeoIndex, SQLiteDB):
 
     def _new_geolocator(self):
         if self.user_agent is None:
@@ -29,69 +35,52 @@ class GeoCodingDB(SQLiteDB):
         logging.info(f"Creating new geolocator with user_agent={self.user_agent}")
         self.geolocator = Nominatim(user_agent=self.user_agent)
 
-    def __init__(self, fp: Path, user_agent: str = None):
+    def __init__(self,
+                 fp: Path,
+                 user_agent: str = None,
+                 policies: dict[str, CachePolicy] = None,
+                 lru_size: int = 100000,
+                 retry: RetryPolicy = None,
+                 store_raw: bool = False,
+                 raw_codec: str = None):
         super().__init__(fp)
         self.user_agent = user_agent
         self._new_geolocator()
-        query = """
-        CREATE TABLE IF NOT EXISTS geocoding (
-            id INTEGER PRIMARY KEY NOT NULL,
-            error TEXT,
-            input TEXT,
-            addresstype TEXT,
-            bounding_box_x1 REAL,
-            bounding_box_y1 REAL,
-            bounding_box_x2 REAL,
-            bounding_box_y2 REAL,
-            class TEXT,
-            display_name TEXT,
-            importance REAL,
-            lat REAL,
-            licence TEXT,
-            lon REAL,
-            name TEXT,
-            osm_id INTEGER,
-            osm_type TEXT,
-            place_id INTEGER,
-            place_rank INTEGER,
-            type TEXT
-        )
-        """
-        self.con.cursor().execute(query)
-        query = "CREATE INDEX IF NOT EXISTS geocoding_input ON geocoding(input)"
-        self.con.cursor().execute(query)
+        # Shared by all the calls, so they all back off when the server is down
+        if retry is None:
+            retry = RetryPolicy(max_attempts=10, backoff_base=2.0, backoff_cap=120.0,
+                                retry_exceptions=(GeocoderTimedOut,
+                                                  GeocoderUnavailable,
+                                                  GeocoderRateLimited))
+        self.retry = retry
+        # Tables `geocoding` and `queries`, shared with NominatimDB
+        # With store_raw, the full responses are also kept, compressed
+        raw = RawPayloads(self, raw_codec) if store_raw else None
+        self.cache = GeoCache(self, "geopy", policies, lru_size, raw)
+        self.cache.ini_db()
+        # Spatial index
+        self.ini_rtree()
 
-    def _do_geocode(self, address, attempt=1, max_attempts=10, sleep_range=(10, 20)):
-        try:
+    def _do_geocode(self, address, max_attempts=None, limiter=None):
+        # GeocoderRateLimited carries the Retry-After of the server
+        def attempt():
+            # Every attempt, retries included, takes a token
+            if limiter is not None:
+                limiter.acquire()
             return self.geolocator.geocode(address, exactly_one=False)
-        except (GeocoderTimedOut, GeocoderUnavailable):
-            if attempt <= max_attempts:
-                sleep_time = random.uniform(*sleep_range)
-                logging.info(
-                    f"Caught exception. Sleeping for {sleep_time:.2f} seconds then retrying"
-                )
-                time.sleep(sleep_time)
-                self._new_geolocator()
-                logging.info("Retrying")
-                return self._do_geocode(
-                    address,
-                    attempt=attempt + 1,
-                    max_attempts=max_attempts,
-                    sleep_range=sleep_range,
-                )
-            raise
-
-    def _get_ids_from_input(self, address: str):
-        query = "SELECT id FROM geocoding WHERE input=?"
-        rows = self.con.cursor().execute(query, [address]).fetchall()
-        if not rows:
-            return None
-        return [row["id"] for row in rows]
+
+        return self.retry.run(
+            attempt,
+            max_attempts=max_attempts,
+            on_retry=lambda reason: logging.info(f"{reason} geocoding '{address}'"),
+        )
 
     def geocode(self, address: str, verbose: bool = False):
+        query = NominatimQuery.from_free_form(address)
+        key = query.canonical_key()
         # If we already have the location, return it
-        ids = self._get_ids_from_input(address)
-        if ids:
+        ids = self.cache.lookup(key, address)
+        if ids is not None:
             if verbose:
                 logging.info(f"Address '{address}' already processed")
             return GeoCodingID(ids=ids, downloaded=False)
@@ -100,19 +89,114 @@ class GeoCodingDB(SQLiteDB):
             logging.info(f'Geolocating "{address}"')
         locs = self._do_geocode(address)
         # Save geolocation into db
-        if not locs:
-            loclist = [{"input": address, "error": "404"}]
-        else:
-            loclist = list()
-            for loc in locs:
-                d = loc.raw
-                d["bounding_box_x1"] = d["boundingbox"][0]
-                d["bounding_box_y1"] = d["boundingbox"][1]
-                d["bounding_box_x2"] = d["boundingbox"][2]
-                d["bounding_box_y2"] = d["boundingbox"][3]
-                del d["boundingbox"]
-                d["input"] = address
-                loclist.append(d)
-        self.insert_into_many("geocoding", loclist)
-        ids = self._get_ids_from_input(address)
+        # No results are kept in the negative cache
+        locs = [loc.raw for loc in locs] if locs else []
+        ids = self.cache.store(key, address, 200, locs)
         return GeoCodingID(ids=ids, downloaded=True)
+
+    def raw(self, address: str) -> Optional[LazyPayload]:
+        """
+        The full response stored for an address, decompressed on access.
+        None if it was not stored
+        """
+        key = NominatimQuery.from_free_form(address).canonical_key()
+        return self.cache.raw_payload(key)
+
+    def geocode_dataframe(self,
+                          df,
+                          column: str,
+                          workers: int = 1,
+                          rate: float = 1.0,
+                          batch_size: int = 100,
+                          id_column: str = "geocoding_id",
+                          all_ids: bool = False):
+        """
+        Geocode the addresses in a DataFrame column.
+        Addresses are deduplicated, the cached ones are resolved with a few
+        batched queries, only the others are geocoded, and the ids are
+        merged back onto the frame.
+        :param df: The DataFrame
+        :type df: pandas.DataFrame
+        :param column: The column with the addresses
+        :type column: str
+        :param workers: Number of threads querying the geocoder
+        :type workers: int
+        :param rate: Maximum requests per second, across all workers.
+                     The public Nominatim server allows 1 request per second
+        :type rate: float
+        :param batch_size: Number of responses written per transaction
+        :type batch_size: int
+        :param id_column: Name of the column to add
+        :type id_column: str
+        :param all_ids: If True, `id_column` holds the list of the ids of all the
+                        results, otherwise the id of the first result
+                        (<NA> if there are none or geocoding failed)
+        :type all_ids: bool
+        :return: A copy of df with `id_column` added
+        """
+        import numpy as np
+        import pandas as pd
+
+        # Missing values get code -1
+        codes, uniques = pd.factorize(df[column])
+        addresses = [str(a) for a in uniques]
+        keys = [NominatimQuery.from_free_form(a).canonical_key() for a in addresses]
+        # Different spellings can share a canonical key
+        key2address = dict()
+        for key, address in zip(keys, addresses):
+            key2address.setdefault(key, address)
+        ids = self.cache.lookup_many(key2address)
+        misses = [(key, address) for key, address in key2address.items()
+                  if ids[key] is None]
+        logging.info(f"{len(df)} rows, {len(key2address)} unique addresses, "
+                     f"{len(key2address) - len(misses)} already in the db, "
+                     f"{len(misses)} to geocode")
+
+        limiter = TokenBucket(rate)
+
+        def fetch(key, address):
+            return key, address, self._do_geocode(address, limiter=limiter)
+
+        ndownloaded = 0
+        nfailed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch, key, address): address
+                       for key, address in misses}
+            try:
+                for fut in as_completed(futures):
+                    try:
+                        key, address, locs = fut.result()
+                    except self.retry.retry_exceptions as e:
+                        # Left as <NA>, and retried on the next run
+                        logging.error(f"Giving up on '{futures[fut]}': "
+                                      f"{type(e).__name__}")
+                        nfailed += 1
+                        continue
+                    locs = [loc.raw for loc in locs] if locs else []
+                    ids[key] = self.cache.store(key, address, 200, locs)
+                    ndownloaded += 1
+                    if ndownloaded % batch_size == 0:
+                        self.commit()
+                        logging.info(f"Geocoded {ndownloaded}/{len(misses)} "
+                                     f"addresses")
+            except BaseException:
+                # Don't wait for the queued addresses, and keep what was written
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.commit()
+                raise
+        self.commit()
+        logging.info(f"Geocoded {ndownloaded} addresses, {nfailed} failed "
+                     f"(left as <NA>, retried on the next run)")
+
+        # One entry per unique address, plus one for missing values at code -1
+        if all_ids:
+            values = np.full(len(keys) + 1, None, dtype=object)
+            for i, key in enumerate(keys):
+                values[i] = ids[key]
+            return df.assign(**{id_column: values[codes]})
+        values = np.full(len(keys) + 1, -1, dtype=np.int64)
+        for i, key in enumerate(keys):
+            if ids[key]:
+                values[i] = ids[key][0]
+        values = values[codes]
+        return df.assign(**{id_column: pd.arrays.IntegerArray(values, values < 0)})
@@ -4,17 +4,22 @@
 
 import datetime
 import hashlib
-import random
-import time
 from pathlib import Path
 import logging
-import requests
 import json
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
+from typing import Iterable, Optional
 
 from ..SQLiteDB import SQLiteDB
 from ..Logger import Logger
+from ..RateLimiter import TokenBucket
+from ..RetryPolicy import RetryPolicy
+from ..HTTPClient import HTTPClient
+from .GeoIndex import GeoIndex
+from .GeoCache import CachePolicy, GeoCache
+from .RawPayloads import LazyPayload, RawPayloads
 
 @dataclass
 class GeoCodingID:
@@ -27,7 +32,31 @@ class NominatimQuery:
     query:dict[str,str] = None
 
     def update_query(self, d:dict[str,str]) -> None:
-        d.update(query)
+        d.update({k: v for k, v in self.query.items() if v is not None})
+
+    def input_text(self) -> str:
+        """
+        Text stored in the `input` column of the `geocoding` table
+        """
+        if set(self.query) == {"q"}:
+            return self.query["q"]
+        return json.dumps(self.query)
+
+    def canonical_key(self) -> str:
+        """
+        Key identifying the query regardless of trivial differences:
+        None parameters are dropped, names and values are case and whitespace folded
+        and parameters are sorted
+        """
+        params = {
+            " ".join(k.split()).lower(): " ".join(str(v).split()).lower()
+            for k, v in self.query.items()
+            if v is not None
+        }
+        # Empty strings are dropped as well
+        params = {k: v for k, v in params.items() if v}
+        return json.dumps(params, sort_keys=True, ensure_ascii=False,
+                          separators=(",", ":"))
 
     # Free-form query
     # See: https://nominatim.org/release-docs/latest/api/Search/#free-form-query
@@ -55,14 +84,56 @@ class NominatimQuery:
             "postalcode": postalcode
             })
 
-class NominatimDB(SQLiteDB):
+class NominatimDB(GeoIndex, SQLiteDB):
 
-    def __init__(self, fp: Path, logger:Logger=None):
+    def __init__(self,
+                 fp: Path,
+                 logger:Logger=None,
+                 negative_ttl:float=30*24*3600,
+                 policies:Optional[dict[str,CachePolicy]]=None,
+                 lru_size:int=100000,
+                 retry:Optional[RetryPolicy]=None,
+                 http:Optional[HTTPClient]=None,
+                 store_raw:bool=False,
+                 raw_codec:Optional[str]=None):
+        """
+        :param fp: The database file
+        :param logger: The logger. If None, a new one is created
+        :param negative_ttl: Seconds after which queries with no results
+                             (or an HTTP error) are queried again
+        :param policies: Cache policies of the other providers sharing the db
+        :param lru_size: Maximum number of queries kept in memory
+        :param retry: The RetryPolicy shared by all the requests,
+                      so all the workers back off when the server is down.
+                      If None, a new one is created
+        :param http: The HTTPClient, keeping connections to the server alive.
+                     If None, a new one is created
+        :param store_raw: Also store the full responses, compressed,
+                          including the fields without a column in `geocoding`
+        :param raw_codec: "zstd" or "zlib" for the full responses.
+                          None for zstd if installed, zlib otherwise
+        """
         if logger:
             self.logger = logger
         else:
             self.logger = Logger()
         super().__init__(fp)
+        # Only close the HTTP client if it's ours
+        self._own_http = http is None
+        self.http = http if http else HTTPClient(pool_size=4)
+        if retry is None:
+            retry = RetryPolicy(max_attempts=10, backoff_base=2.0, backoff_cap=120.0,
+                                retry_exceptions=self.http.errors)
+        self.retry = retry
+        policies = dict(policies) if policies else dict()
+        policies["nominatim"] = CachePolicy(negative_ttl=negative_ttl)
+        raw = RawPayloads(self, raw_codec) if store_raw else None
+        self.cache = GeoCache(self, "nominatim", policies, lru_size, raw)
+
+    def close(self) -> None:
+        if getattr(self, "_own_http", False):
+            self.http.close()
+        super().close()
 
     def ini_db(self,  if_not_exists:bool=True) -> None:
         # If not exists statement
@@ -70,33 +141,8 @@ class NominatimDB(SQLiteDB):
             if_not_exists = "IF NOT EXISTS"
         else:
             if_not_exists = ""
-        # Tabe `geocoding`
-        query = f"""
-        CREATE TABLE {if_not_exists} geocoding (
-            id INTEGER PRIMARY KEY NOT NULL,
-            input TEXT NOT NULL,
-            status_code INTEGER NOT NULL,
-            nres INTEGER,
-            addresstype TEXT,
-            bounding_box_x1 REAL,
-            bounding_box_y1 REAL,
-            bounding_box_x2 REAL,
-            bounding_box_y2 REAL,
-            class TEXT,
-            display_name TEXT,
-            importance REAL,
-            lat REAL,
-            licence TEXT,
-            lon REAL,
-            name TEXT,
-            osm_id INTEGER,
-            osm_type TEXT,
-            place_id INTEGER,
-            place_rank INTEGER,
-            type TEXT
-        )
-        """
-        self.con.cursor().execute(query)
+        # Tables `geocoding` and `queries`, shared with GeoCodingDB
+        self.cache.ini_db()
         # Table `addresses_to_geocoding`
         query = f"""
         CREATE TABLE {if_not_exists} addresses_to_geocoding
@@ -108,23 +154,22 @@ class NominatimDB(SQLiteDB):
         )
         """
         self.con.cursor().execute(query)
-        # Indexes
-        query = "CREATE INDEX IF NOT EXISTS geocoding_input ON geocoding(input)"
-        self.con.cursor().execute(query)
+        # Spatial index
+        self.ini_rtree()
 
-    def _get_geocoding_ids_from_input(self, inputtxt: str):
-        query = "SELECT id FROM geocoding WHERE input=?"
-        rows = self.con.cursor().execute(query, [inputtxt]).fetchall()
-        if not rows:
-            return None
-        return [row["id"] for row in rows]
+    def _lookup(self, query:NominatimQuery) -> Optional[list[int]]:
+        """
+        Return the geocoding ids cached for a query,
+        an empty list if the query is in the negative cache,
+        None if the query must be (re-)downloaded
+        """
+        return self.cache.lookup(query.canonical_key(), query.input_text())
 
     def geocode(self,
                 query:NominatimQuery,
                 limit:int=10,
                 verbose:bool=False,
-                error_sleep_time:tuple[int,int]=(20,30),
-                max_attempts:int=10):
+                max_attempts:Optional[int]=None):
         """
         Geocode an  address using Nominatim API
         :param query: The query to search
@@ -133,77 +178,168 @@ class NominatimDB(SQLiteDB):
         :type limit: int
         :param verbose: Be chatty
         :type verbose: bool
-        :param error_sleep_time: A tuple indicating the minimum and maximum seconds to sleep before retrying in case of errors
-        :type error_sleep_time: tuple[int,int]
-        :param max_attempts: The maximum number of attempts to perform in case of errors
-        :type max_attemps: int
+        :param max_attempts: The maximum number of attempts to perform in case of errors.
+                             If None, the one of self.retry
+        :type max_attempts: Optional[int]
+        :raises Exception: If the server still answers HTTP 429/5xx after
+                           all the attempts (the query is not cached)
         """
+        address = query.input_text()
         # If we already have the location, return it
-        geocoding_ids = self._get_geocoding_ids_from_input(address)
-        if geocoding_ids:
+        geocoding_ids = self._lookup(query)
+        if geocoding_ids is not None:
             if verbose:
                 logging.info(f"Address '{address}' already processed")
             return GeoCodingID(ids=geocoding_ids, downloaded=False)
         # Otherwise, geocode the new address
         if verbose:
             logging.info(f'Geolocating "{address}"')
-        # Query the API
+        status_code, locs = self._fetch(query, limit, max_attempts)
+        if self._transient(status_code):
+            raise Exception(f"HTTP {status_code} geocoding '{address}' "
+                            f"after all the attempts")
+        geocoding_ids = self._store(query, status_code, locs)
+        # Return geocoding.id
+        return GeoCodingID(ids=geocoding_ids, downloaded=True)
+
+    def _fetch(self,
+               query:NominatimQuery,
+               limit:int,
+               max_attempts:Optional[int]=None,
+               limiter:Optional[TokenBucket]=None) -> tuple[int, list[dict]]:
+        """
+        Query the API. Return the HTTP status code and the results.
+        Connection errors, timeouts and HTTP 429/5xx are retried according
+        to self.retry. If they persist, the last exception is raised,
+        or the last status code is returned.
+        If given, a token is taken from `limiter` before every attempt.
+        """
         url = "https://nominatim.openstreetmap.org/search"
         params = {
             "format": "json",
             "limit": limit
             }
         query.update_query(params)
-        resp = None
-        for attempt in range(1, max_attempts+1):
-            if attempt > 1:
-                logging.info(f"Attempt={attempt}")
-            try:
-                resp = requests.get(url, params=params)
-            except requests.ConnectionError:
-                sleep_time = random.uniform(*error_sleep_time)
-                msg = f"ConnectionError for {url}\n" \
-                      f"Waiting {sleep_time} then retrying..."
-                self.logger.log_exception()
-                self.logger.error(msg)
-                time.sleep(sleep_time)
-                continue
-            else:
-                break
-        if resp is None:
-            raise Exception("Max attempts exceeded without being able to download the url")
+
+        def on_retry(reason):
+            self.logger.error(f"{reason} for {url} with params {params}")
+
+        def attempt():
+            if limiter is not None:
+                limiter.acquire()
+            return self.http.get(url, params=params)
+
+        resp = self.retry.run(attempt, max_attempts=max_attempts, on_retry=on_retry)
         # Handle HTTP errors
         if resp.status_code != 200:
             locs = []
-            nres = None
         else:
             # Parse response as JSON
             # WARNING: This can return an empty list
             locs = json.loads(resp.text)
-            nres = len(locs)
-        # Insert into `geocoding` table
-        loclist = list()
-        if locs:
-            for loc in locs:
-                loc["input"] = address
-                loc["status_code"] = resp.status_code
-                loc["nres"] = nres
-                if "boundingbox" in loc:
-                    loc["bounding_box_x1"] = loc["boundingbox"][0]
-                    loc["bounding_box_y1"] = loc["boundingbox"][1]
-                    loc["bounding_box_x2"] = loc["boundingbox"][2]
-                    loc["bounding_box_y2"] = loc["boundingbox"][3]
-                    del loc["boundingbox"]
-                loclist.append(loc)
-        else:
-            loc = {
-                   "input": address,
-                   "status_code": resp.status_code,
-                   "nres": nres
-                  }
-            loclist.append(loc)
-        default_keys = {"osm_type":"", "osm_id":""}
-        self.insert_into_many("geocoding", loclist, default_keys=default_keys)
-        geocoding_ids = self._get_geocoding_ids_from_input(address)
-        # Return geocoding.id
-        return GeoCodingID(ids=geocoding_ids, downloaded=True)
+        return resp.status_code, locs
+
+    def _transient(self, status_code:int) -> bool:
+        """
+        Whether a status code is a failure of the server rather than an answer
+        about the query. Such responses are not cached (not even in the
+        negative cache), so the query is downloaded again on the next run
+        """
+        return status_code in self.retry.retry_statuses or status_code >= 500
+
+    def raw(self, query:NominatimQuery) -> Optional[LazyPayload]:
+        """
+        The full response stored for a query, decompressed on access.
+        None if it was not stored
+        """
+        return self.cache.raw_payload(query.canonical_key())
+
+    def _store(self, query:NominatimQuery, status_code:int, locs:list[dict]) -> list[int]:
+        """
+        Insert an API response into the cache. Return the new geocoding ids.
+        """
+        return self.cache.store(query.canonical_key(), query.input_text(),
+                                status_code, locs)
+
+    def geocode_many(self,
+                     queries:Iterable[NominatimQuery],
+                     workers:int=4,
+                     rate:float=1.0,
+                     limit:int=10,
+                     batch_size:int=100,
+                     max_attempts:Optional[int]=None) -> dict[str,int]:
+        """
+        Geocode many queries concurrently.
+        Duplicate queries and queries already in the db are geocoded only once.
+        :param queries: The queries to geocode
+        :type queries: Iterable[NominatimQuery]
+        :param workers: Number of threads querying the API
+        :type workers: int
+        :param rate: Maximum requests per second, across all workers.
+                     The public Nominatim server allows 1 request per second
+        :type rate: float
+        :param limit: The maximum number of search results to return per query
+        :type limit: int
+        :param batch_size: Number of responses written per transaction
+        :type batch_size: int
+        :return: Number of unique queries, queries already in the db, queries downloaded
+                 and queries that failed after all the retries, with connection
+                 errors or HTTP 429/5xx (not stored, retried on the next run)
+        """
+        # Dedupe
+        unique = dict()
+        for query in queries:
+            unique.setdefault(query.canonical_key(), query)
+        cached = self.cache.lookup_many({key: query.input_text()
+                                         for key, query in unique.items()})
+        misses = [(key, query) for key, query in unique.items()
+                  if cached[key] is None]
+        ncached = len(unique) - len(misses)
+        self.logger.info(f"{len(unique)} unique queries, {ncached} already in the db, "
+                         f"{len(misses)} to geocode")
+
+        limiter = TokenBucket(rate)
+        self.http.ensure_pool_size(workers)
+
+        def fetch(query):
+            # Retries take a token too
+            return self._fetch(query, limit, max_attempts, limiter)
+
+        ndownloaded = 0
+        nfailed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch, query): query for _, query in misses}
+            try:
+                for fut in as_completed(futures):
+                    query = futures[fut]
+                    try:
+                        status_code, locs = fut.result()
+                    except self.retry.retry_exceptions as e:
+                        # Not stored, so it's retried on the next run
+                        self.logger.error(f"Giving up on '{query.input_text()}': "
+                                          f"{type(e).__name__}")
+                        nfailed += 1
+                        continue
+                    if self._transient(status_code):
+                        self.logger.error(f"Giving up on '{query.input_text()}': "
+                                          f"HTTP {status_code}")
+                        nfailed += 1
+                        continue
+                    self._store(query, status_code, locs)
+                    ndownloaded += 1
+                    if ndownloaded % batch_size == 0:
+                        self.commit()
+                        self.logger.info(f"Geocoded {ndownloaded}/{len(misses)} "
+                                         f"queries")
+            except BaseException:
+                # Don't wait for the queued queries, and keep what was written
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.commit()
+                raise
+        self.commit()
+        metrics = self.retry.metrics
+        self.logger.info(f"{metrics.retries} retries, {metrics.failures} failures, "
+                         f"{metrics.circuit_opens} circuit opens, "
+                         f"{metrics.wait_seconds:.1f} seconds spent waiting")
+        return {"queries": len(unique), "cached": ncached, "downloaded": ndownloaded,
+                "failed": nfailed}
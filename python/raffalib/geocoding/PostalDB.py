@@ -2,21 +2,102 @@
 # Copyright 2023 Raffaele Mancuso
 # SPDX-License-Identifier: GPL-2.0-or-later
 
-import datetime
-import hashlib
-import random
-import time
+import re
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import logging
-import requests
-import json
+from typing import Iterable, Optional
 
-from dataclasses import dataclass
+from ..SQLiteDB import SQLiteDB
+from ..Logger import Logger
+from .NominatimDB import NominatimQuery
+
+# libpostal labels
+# See: https://github.com/openvenues/libpostal#parser-labels
+LABELS = [
+    "house", "category", "near", "house_number", "road", "unit", "level",
+    "staircase", "entrance", "po_box", "postcode", "suburb", "city_district",
+    "city", "island", "state_district", "state", "country_region", "country",
+    "world_region",
+]
+
+try:
+    from postal.parser import parse_address as _postal_parse_address
+except ImportError:
+    _postal_parse_address = None
+
+_RE_SPACES = re.compile(r"\s+")
+# Numeric postcodes, or UK style ones
+_RE_POSTCODE = re.compile(r"\b(\d{4,6}|[A-Z]{1,2}\d[A-Z\d]? ?\d[A-Z]{2})\b",
+                          re.IGNORECASE)
+_RE_HOUSE_NUMBER = re.compile(r"^(\d+[a-z]?)\s+(.*)$|^(.*?),?\s+(\d+[a-z]?)$")
+
+
+def normalize_address(address: str) -> str:
+    """
+    Unicode NFKC, lowercase and fold whitespace
+    """
+    address = unicodedata.normalize("NFKC", address).lower()
+    return _RE_SPACES.sub(" ", address).strip(" ,")
+
+
+def _fallback_parse_address(address: str) -> dict[str, str]:
+    """
+    Pure-Python heuristic parser for "number road, [postcode] city, [state,] country"
+    style addresses, used when libpostal is not installed
+    """
+    parts = [p.strip() for p in address.split(",") if p.strip()]
+    res = dict()
+    if not parts:
+        return res
+    # Postcode, in any part but the first
+    for i, part in enumerate(parts[1:], start=1):
+        m = _RE_POSTCODE.search(part)
+        if m:
+            res["postcode"] = m.group(1)
+            rest = (part[:m.start()] + part[m.end():]).strip()
+            if rest:
+                parts[i] = rest
+            else:
+                del parts[i]
+            break
+    # House number and road
+    m = _RE_HOUSE_NUMBER.match(parts[0])
+    if m:
+        res["house_number"] = m.group(1) or m.group(4)
+        res["road"] = (m.group(2) or m.group(3)).strip()
+    else:
+        res["road"] = parts[0]
+    rest = parts[1:]
+    if len(rest) >= 3:
+        res["city"], res["state"], res["country"] = rest[0], rest[-2], rest[-1]
+    elif len(rest) == 2:
+        res["city"], res["country"] = rest
+    elif len(rest) == 1:
+        res["city"] = rest[0]
+    return res
+
+
+def parse_address(address: str) -> dict[str, str]:
+    """
+    Parse a normalized address into its libpostal components,
+    with libpostal if installed, otherwise with a heuristic fallback.
+    Top-level so it can be pickled to worker processes.
+    """
+    if _postal_parse_address is not None:
+        res = dict()
+        for value, label in _postal_parse_address(address):
+            # libpostal may return the same label twice, keep the first one
+            res.setdefault(label, value)
+        return res
+    return _fallback_parse_address(address)
 
-from .SQLiteDB import SQLiteDB
-from .Logger import Logger
 
 class PostalDB(SQLiteDB):
+    """
+    Local address parsing stage, with the parsed components
+    cached in the `postal` table
+    """
 
     def __init__(self, fp: Path, logger:Logger=None):
         if logger:
@@ -24,142 +105,113 @@ class PostalDB(SQLiteDB):
         else:
             self.logger = Logger()
         super().__init__(fp)
+        self.ini_db()
+        if _postal_parse_address is None:
+            self.logger.warning("libpostal not installed, "
+                                "using the fallback address parser")
 
-    def ini_db(self) -> None:
-        # Tabe `postal`
+    def ini_db(self, if_not_exists:bool=True) -> None:
+        # If not exists statement
+        if if_not_exists:
+            if_not_exists = "IF NOT EXISTS"
+        else:
+            if_not_exists = ""
+        # Table `postal`
+        cols = ",\n".join([f"{label} TEXT" for label in LABELS])
         query = f"""
-        CREATE TABLE postal (
+        CREATE TABLE {if_not_exists} postal (
             id INTEGER PRIMARY KEY NOT NULL,
-            input TEXT NOT NULL,
-            status_code INTEGER NOT NULL,
-            nres INTEGER,
-            addresstype TEXT,
-            bounding_box_x1 REAL,
-            bounding_box_y1 REAL,
-            bounding_box_x2 REAL,
-            bounding_box_y2 REAL,
-            class TEXT,
-            display_name TEXT,
-            importance REAL,
-            lat REAL,
-            licence TEXT,
-            lon REAL,
-            name TEXT,
-            osm_id INTEGER,
-            osm_type TEXT,
-            place_id INTEGER,
-            place_rank INTEGER,
-            type TEXT
+            input TEXT NOT NULL UNIQUE,
+            parser TEXT NOT NULL,
+            {cols}
         )
         """
         self.con.cursor().execute(query)
-        # Table `addresses_to_geocoding`
-        query = f"""
-        CREATE TABLE {if_not_exists} addresses_to_geocoding
-        (
-            id INTEGER PRIMARY KEY,
-            addresses_id INTEGER REFERENCES addresses(id),
-            geocoding_id INTEGER REFERENCES geocoding(id),
-            UNIQUE(addresses_id, geocoding_id)
-        )
+
+    @staticmethod
+    def _row(address:str, components:dict[str,str]) -> dict[str,Optional[str]]:
+        row = {label: components.get(label) for label in LABELS}
+        row["input"] = address
+        row["parser"] = "libpostal" if _postal_parse_address else "fallback"
+        return row
+
+    def _get_cached(self, addresses:list[str]) -> dict[str,dict[str,str]]:
+        res = dict()
+        cols = ",".join(LABELS)
+        # Stay below SQLite's limit of bound variables
+        for i in range(0, len(addresses), 500):
+            chunk = addresses[i:i+500]
+            phs = ",".join(["?"] * len(chunk))
+            query = f"SELECT input, {cols} FROM postal WHERE input IN ({phs})"
+            for row in self.con.cursor().execute(query, chunk):
+                res[row["input"]] = {k: row[k] for k in LABELS if row[k] is not None}
+        return res
+
+    def parse(self, address:str) -> dict[str,str]:
         """
-        self.con.cursor().execute(query)
-        # Indexes
-        query = "CREATE INDEX IF NOT EXISTS geocoding_input ON geocoding(input)"
-        self.con.cursor().execute(query)
+        Parse a single address, using the cache
+        """
+        return self.parse_many([address], workers=1)[normalize_address(address)]
 
-    def _get_geocoding_ids_from_input(self, inputtxt: str):
-        query = "SELECT id FROM geocoding WHERE input=?"
-        rows = self.con.cursor().execute(query, [inputtxt]).fetchall()
-        if not rows:
-            return None
-        return [row["id"] for row in rows]
-
-    def geocode(self,
-                query:NominatimQuery,
-                limit:int=10,
-                verbose:bool=False,
-                error_sleep_time:tuple[int,int]=(20,30),
-                max_attempts:int=10):
+    def parse_many(self,
+                   addresses:Iterable[str],
+                   workers:Optional[int]=None,
+                   chunksize:int=1000) -> dict[str,dict[str,str]]:
         """
-        Geocode an  address using Nominatim API
-        :param query: The query to search
-        :type query: NominatimQuery
-        :param limit: The maximum number of search results to return
-        :type limit: int
-        :param verbose: Be chatty
-        :type verbose: bool
-        :param error_sleep_time: A tuple indicating the minimum and maximum seconds to sleep before retrying in case of errors
-        :type error_sleep_time: tuple[int,int]
-        :param max_attempts: The maximum number of attempts to perform in case of errors
-        :type max_attemps: int
+        Parse many addresses.
+        Addresses are normalized and deduplicated, cached ones are read
+        from the `postal` table and the others are parsed in a process pool
+        and cached.
+        Note that every worker process loads its own copy of libpostal's model.
+        :param addresses: The addresses to parse
+        :type addresses: Iterable[str]
+        :param workers: Number of worker processes. 1 to parse in this process.
+                        None for one per CPU
+        :type workers: Optional[int]
+        :param chunksize: Addresses sent to a worker at a time
+        :type chunksize: int
+        :return: Normalized address -> components
         """
-        # If we already have the location, return it
-        geocoding_ids = self._get_geocoding_ids_from_input(address)
-        if geocoding_ids:
-            if verbose:
-                logging.info(f"Address '{address}' already processed")
-            return GeoCodingID(ids=geocoding_ids, downloaded=False)
-        # Otherwise, geocode the new address
-        if verbose:
-            logging.info(f'Geolocating "{address}"')
-        # Query the API
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {
-            "format": "json",
-            "limit": limit
-            }
-        query.update_query(params)
-        resp = None
-        for attempt in range(1, max_attempts+1):
-            if attempt > 1:
-                logging.info(f"Attempt={attempt}")
-            try:
-                resp = requests.get(url, params=params)
-            except requests.ConnectionError:
-                sleep_time = random.uniform(*error_sleep_time)
-                msg = f"ConnectionError for {url}\n" \
-                      f"Waiting {sleep_time} then retrying..."
-                self.logger.log_exception()
-                self.logger.error(msg)
-                time.sleep(sleep_time)
-                continue
-            else:
-                break
-        if resp is None:
-            raise Exception("Max attempts exceeded without being able to download the url")
-        # Handle HTTP errors
-        if resp.status_code != 200:
-            locs = []
-            nres = None
-        else:
-            # Parse response as JSON
-            # WARNING: This can return an empty list
-            locs = json.loads(resp.text)
-            nres = len(locs)
-        # Insert into `geocoding` table
-        loclist = list()
-        if locs:
-            for loc in locs:
-                loc["input"] = address
-                loc["status_code"] = resp.status_code
-                loc["nres"] = nres
-                if "boundingbox" in loc:
-                    loc["bounding_box_x1"] = loc["boundingbox"][0]
-                    loc["bounding_box_y1"] = loc["boundingbox"][1]
-                    loc["bounding_box_x2"] = loc["boundingbox"][2]
-                    loc["bounding_box_y2"] = loc["boundingbox"][3]
-                    del loc["boundingbox"]
-                loclist.append(loc)
+        unique = list(dict.fromkeys(normalize_address(a) for a in addresses))
+        res = self._get_cached(unique)
+        misses = [a for a in unique if a not in res]
+        self.logger.info(f"{len(unique)} unique addresses, {len(res)} already parsed, "
+                         f"{len(misses)} to parse")
+        if not misses:
+            return res
+        if workers == 1:
+            self._store(misses, map(parse_address, misses), res)
         else:
-            loc = {
-                   "input": address,
-                   "status_code": resp.status_code,
-                   "nres": nres
-                  }
-            loclist.append(loc)
-        default_keys = {"osm_type":"", "osm_id":""}
-        self.insert_into_many("geocoding", loclist, default_keys=default_keys)
-        geocoding_ids = self._get_geocoding_ids_from_input(address)
-        # Return geocoding.id
-        return GeoCodingID(ids=geocoding_ids, downloaded=True)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parsed = executor.map(parse_address, misses, chunksize=chunksize)
+                self._store(misses, parsed, res)
+        return res
+
+    def _store(self,
+               addresses:list[str],
+               parsed:Iterable[dict[str,str]],
+               res:dict[str,dict[str,str]]) -> None:
+        """
+        Cache the parsed addresses in the `postal` table, as they arrive
+        """
+        def rows():
+            for address, components in zip(addresses, parsed):
+                res[address] = components
+                yield self._row(address, components)
+        self.insert_stream("postal", rows(), crs="IGNORE")
+
+    @staticmethod
+    def to_query(components:dict[str,str]) -> NominatimQuery:
+        """
+        Structured Nominatim query from parsed address components
+        """
+        street = " ".join(filter(None, [components.get("house_number"),
+                                        components.get("road")]))
+        return NominatimQuery.from_structured(
+            amenity=components.get("house"),
+            street=street or None,
+            city=components.get("city") or components.get("suburb"),
+            county=components.get("state_district"),
+            state=components.get("state"),
+            country=components.get("country"),
+            postalcode=components.get("postcode"))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import logging
+import zlib
+from typing import Any, Iterator, Optional
+
+from ..SQLiteDB import SQLiteDB
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# zlib can't use a preset dictionary larger than its 32 KiB window
+ZLIB_MAX_DICT_SIZE = 32 * 1024
+
+_NOT_LOADED = object()
+
+
+class LazyPayload:
+    """
+    A compressed payload, decompressed and parsed on first access
+    """
+
+    __slots__ = ("_store", "_blob", "_codec", "_dict_id", "_value")
+
+    def __init__(self, store: "RawPayloads", blob: bytes, codec: str,
+                 dict_id: Optional[int]) -> None:
+        self._store = store
+        self._blob = blob
+        self._codec = codec
+        self._dict_id = dict_id
+        self._value = _NOT_LOADED
+
+    @property
+    def compressed_size(self) -> int:
+        return len(self._blob)
+
+    @property
+    def value(self) -> Any:
+        if self._value is _NOT_LOADED:
+            data = self._store.decompress(self._blob, self._codec, self._dict_id)
+            self._value = json.loads(data)
+        return self._value
+
+    def __getitem__(self, item):
+        return self.value[item]
+
+    def __len__(self) -> int:
+        return len(self.value)
+
+    def __iter__(self):
+        return iter(self.value)
+
+
+class RawPayloads:
+    """
+    Full raw JSON responses of the geocoding queries, compressed,
+    in the `raw_payloads` table (one row per canonical query key).
+    The payloads repeat the same long strings (licence, parts of
+    display_name, keys), so after the first `dict_samples` payloads
+    a preset dictionary is built from them and stored in `raw_dicts`,
+    and the following payloads are compressed against it.
+    Payloads are only decompressed when accessed.
+    """
+
+    def __init__(
+        self,
+        db: SQLiteDB,
+        codec: Optional[str] = None,
+        level: Optional[int] = None,
+        dict_samples: int = 200,
+        dict_size: int = 16 * 1024,
+    ) -> None:
+        """
+        :param db: The database
+        :param codec: "zstd" or "zlib". None for zstd if the zstandard package
+                      is installed, zlib otherwise
+        :param level: Compression level. None for the codec's default
+        :param dict_samples: Payloads to collect before building the dictionary.
+                             0 to never build one
+        :param dict_size: Dictionary size in bytes
+        """
+        if codec is None:
+            codec = "zstd" if zstandard is not None else "zlib"
+        if codec not in ("zstd", "zlib"):
+            raise Exception(f"Unknown codec '{codec}'")
+        if codec == "zstd" and zstandard is None:
+            raise Exception("codec='zstd' requires zstandard: pip install zstandard")
+        if codec == "zlib":
+            dict_size = min(dict_size, ZLIB_MAX_DICT_SIZE)
+        self.db = db
+        self.codec = codec
+        self.level = level
+        self.dict_samples = dict_samples
+        self.dict_size = dict_size
+        self.dict_id: Optional[int] = None
+        self._samples: list[bytes] = list()
+        # dict_id -> dictionary bytes (or zstandard.ZstdCompressionDict)
+        self._dicts: dict[int, Any] = dict()
+        self._compressor = None
+
+    def ini_db(self) -> None:
+        cur = self.db.con.cursor()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS raw_dicts
+        (
+            id INTEGER PRIMARY KEY NOT NULL,
+            codec TEXT NOT NULL,
+            dict BLOB NOT NULL
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS raw_payloads
+        (
+            query_key TEXT PRIMARY KEY NOT NULL,
+            codec TEXT NOT NULL,
+            dict_id INTEGER REFERENCES raw_dicts(id),
+            size INTEGER NOT NULL,
+            payload BLOB NOT NULL
+        )
+        """)
+        # Keep using the latest dictionary of our codec
+        query = "SELECT id FROM raw_dicts WHERE codec=? ORDER BY id DESC LIMIT 1"
+        row = cur.execute(query, [self.codec]).fetchone()
+        if row is not None:
+            self.dict_id = row["id"]
+
+    def _dict(self, dict_id: int) -> Any:
+        d = self._dicts.get(dict_id)
+        if d is None:
+            query = "SELECT codec, dict FROM raw_dicts WHERE id=?"
+            row = self.db.con.cursor().execute(query, [dict_id]).fetchone()
+            d = bytes(row["dict"])
+            if row["codec"] == "zstd":
+                d = zstandard.ZstdCompressionDict(d)
+            self._dicts[dict_id] = d
+        return d
+
+    def _build_dict(self) -> None:
+        samples, self._samples = self._samples, list()
+        if self.codec == "zstd":
+            try:
+                d = zstandard.train_dictionary(self.dict_size, samples)
+                data = d.as_bytes()
+            except zstandard.ZstdError:
+                # Too few samples to train, use their raw content
+                data = b"".join(samples)[-self.dict_size:]
+        else:
+            # zlib looks for matches at the end of the dictionary first,
+            # so the most recent samples go last
+            data = b"".join(samples)[-self.dict_size:]
+        cur = self.db.insert_into("raw_dicts", {"codec": self.codec, "dict": data})
+        self.dict_id = cur.lastrowid
+        self._compressor = None
+        logging.info(f"Built a {len(data)} bytes {self.codec} dictionary "
+                     f"from {len(samples)} payloads")
+
+    def compress(self, data: bytes) -> bytes:
+        if self.codec == "zstd":
+            if self._compressor is None:
+                kwargs = dict()
+                if self.level is not None:
+                    kwargs["level"] = self.level
+                if self.dict_id is not None:
+                    kwargs["dict_data"] = self._dict(self.dict_id)
+                self._compressor = zstandard.ZstdCompressor(**kwargs)
+            return self._compressor.compress(data)
+        level = -1 if self.level is None else self.level
+        if self.dict_id is None:
+            return zlib.compress(data, level)
+        c = zlib.compressobj(level, zdict=self._dict(self.dict_id))
+        return c.compress(data) + c.flush()
+
+    def decompress(self, blob: bytes, codec: str, dict_id: Optional[int]) -> bytes:
+        if codec == "zstd":
+            if zstandard is None:
+                raise Exception("Payload compressed with zstd, "
+                                "but zstandard is not installed")
+            if dict_id is None:
+                return zstandard.ZstdDecompressor().decompress(blob)
+            d = self._dict(dict_id)
+            return zstandard.ZstdDecompressor(dict_data=d).decompress(blob)
+        if dict_id is None:
+            return zlib.decompress(blob)
+        d = zlib.decompressobj(zdict=self._dict(dict_id))
+        return d.decompress(blob) + d.flush()
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Store the raw payload of a query. Does not commit.
+        """
+        data = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        data = data.encode("utf8")
+        if self.dict_id is None and self.dict_samples:
+            self._samples.append(data)
+            if len(self._samples) >= self.dict_samples:
+                self._build_dict()
+        self.db.insert_into("raw_payloads", {
+            "query_key": key,
+            "codec": self.codec,
+            "dict_id": self.dict_id,
+            "size": len(data),
+            "payload": self.compress(data),
+        }, crs="REPLACE")
+
+    def _payload(self, row) -> LazyPayload:
+        return LazyPayload(self, bytes(row["payload"]), row["codec"], row["dict_id"])
+
+    def get(self, key: str) -> Optional[LazyPayload]:
+        """
+        The raw payload of a query, None if it was not stored
+        """
+        query = "SELECT codec, dict_id, payload FROM raw_payloads WHERE query_key=?"
+        row = self.db.con.cursor().execute(query, [key]).fetchone()
+        return None if row is None else self._payload(row)
+
+    def iter(self) -> Iterator[tuple[str, LazyPayload]]:
+        """
+        (query key, payload) of all the stored payloads
+        """
+        query = "SELECT query_key, codec, dict_id, payload FROM raw_payloads"
+        for row in self.db.con.cursor().execute(query):
+            yield row["query_key"], self._payload(row)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Number of payloads, and their total size before and after compression
+        """
+        query = """
+        SELECT COUNT(*) AS n, SUM(size) AS size, SUM(LENGTH(payload)) AS compressed
+        FROM raw_payloads
+        """
+        row = self.db.con.cursor().execute(query).fetchone()
+        return {"payloads": row["n"], "size": row["size"] or 0,
+                "compressed": row["compressed"] or 0}
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# Copyright 2023 Raffaele Mancuso
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import logging
+import math
+import os
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from ..SQLiteDB import SQLiteDB
+from .GeoIndex import EARTH_RADIUS
+
+
+class ReverseGeocoder:
+    """
+    Offline reverse geocoding over the results cached in a geocoding table.
+    Points are bucketed in a regular lat/lon grid stored as NumPy arrays
+    sorted by cell, so a query only looks at the cells around the point.
+    The index can be saved to a directory and loaded back memory-mapped.
+
+    Rows deleted from the table (e.g. GeoCache.store replaces the rows
+    of a re-downloaded query) or whose coordinates changed are recorded
+    by triggers in the `<table>_rg_changes` table, and update() removes
+    them from the index. label() skips ids that no longer exist
+    or whose coordinates changed, but query() can return stale ids
+    until the next update().
+
+    Usage:
+        rg = ReverseGeocoder.build(db)
+        rg.save("rg_index")
+        rg = ReverseGeocoder.load("rg_index")
+        rg.update(db)  # index rows added since the build
+        rg.label(db, 45.46, 9.19)
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        cell: float,
+        max_id: int,
+        table: str = "geocoding",
+    ) -> None:
+        """
+        Use build() or load() instead
+        :param ids: Row ids, sorted by cell
+        :param lat: Latitudes in degrees, sorted by cell
+        :param lon: Longitudes in degrees, sorted by cell
+        :param cell: Grid cell size in degrees
+        :param max_id: Largest row id in the index
+        :param table: The table the index was built from
+        """
+        self.ids = ids
+        self.lat = lat
+        self.lon = lon
+        self.cell = cell
+        self.max_id = max_id
+        self.table = table
+        # Last row of the changes table already applied to the index.
+        # None if unknown (saved by a version not tracking changes)
+        self.changes_seq: Optional[int] = 0
+        self.nrows = int(math.ceil(180 / cell))
+        self.ncols = int(math.ceil(360 / cell))
+        self.cells = self._cells(lat, lon)
+        # Rows added by update(), searched linearly until the next rebuild
+        self.delta_ids = np.empty(0, dtype=np.int64)
+        self.delta_lat = np.empty(0, dtype=np.float64)
+        self.delta_lon = np.empty(0, dtype=np.float64)
+
+    def _rowcol(self, lat, lon):
+        row = np.clip(((np.asarray(lat) + 90) // self.cell).astype(np.int64),
+                      0, self.nrows - 1)
+        col = np.clip(((np.asarray(lon) + 180) // self.cell).astype(np.int64),
+                      0, self.ncols - 1)
+        return row, col
+
+    def _cells(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        row, col = self._rowcol(lat, lon)
+        return row * self.ncols + col
+
+    @staticmethod
+    def _read(db: SQLiteDB, table: str, min_id: int = 0):
+        query = f"""
+        SELECT id, lat, lon FROM {table}
+        WHERE id > ? AND lat IS NOT NULL AND lon IS NOT NULL
+        """
+        ids, lat, lon = [], [], []
+        for _, cols in db.iter_batches(query, [min_id]):
+            ids.append(np.asarray(cols[0], dtype=np.int64))
+            lat.append(np.asarray(cols[1], dtype=np.float64))
+            lon.append(np.asarray(cols[2], dtype=np.float64))
+        if not ids:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64),
+                    np.empty(0, dtype=np.float64))
+        return np.concatenate(ids), np.concatenate(lat), np.concatenate(lon)
+
+    @staticmethod
+    def _read_ids(db: SQLiteDB, table: str, ids: np.ndarray):
+        """
+        id, lat, lon of the rows with the given ids that still have coordinates
+        """
+        out_ids, lat, lon = [], [], []
+        # Stay well below SQLite's bound variables limit
+        for i in range(0, len(ids), 500):
+            chunk = [int(x) for x in ids[i:i + 500]]
+            query = f"""
+            SELECT id, lat, lon FROM {table}
+            WHERE id IN ({",".join(["?"] * len(chunk))})
+            AND lat IS NOT NULL AND lon IS NOT NULL
+            """
+            for row in db.con.cursor().execute(query, chunk):
+                out_ids.append(row["id"])
+                lat.append(row["lat"])
+                lon.append(row["lon"])
+        return (np.asarray(out_ids, dtype=np.int64),
+                np.asarray(lat, dtype=np.float64),
+                np.asarray(lon, dtype=np.float64))
+
+    @staticmethod
+    def ini_changes(db: SQLiteDB, table: str = "geocoding") -> int:
+        """
+        Create the `<table>_rg_changes` table and the triggers recording
+        in it the ids of the rows of `table` deleted or updated.
+        Return the last sequence number in it.
+        """
+        changes = f"{table}_rg_changes"
+        cur = db.con.cursor()
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {changes}
+        (
+            seq INTEGER PRIMARY KEY,
+            row_id INTEGER NOT NULL
+        )
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {changes}_delete AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO {changes} (row_id) VALUES (OLD.id);
+        END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {changes}_update
+        AFTER UPDATE OF id, lat, lon ON {table}
+        BEGIN
+            INSERT INTO {changes} (row_id) VALUES (OLD.id);
+            INSERT INTO {changes} (row_id) VALUES (NEW.id);
+        END
+        """)
+        query = f"SELECT COALESCE(MAX(seq), 0) FROM {changes}"
+        return cur.execute(query).fetchone()[0]
+
+    @classmethod
+    def build(
+        cls, db: SQLiteDB, table: str = "geocoding", cell: float = 0.5
+    ) -> "ReverseGeocoder":
+        """
+        Build the index from the lat/lon of all the rows of `table`
+        :param db: The database
+        :param table: The geocoding table
+        :param cell: Grid cell size in degrees
+        """
+        # Before reading, so changes made meanwhile are applied by update()
+        changes_seq = cls.ini_changes(db, table)
+        ids, lat, lon = cls._read(db, table)
+        rg = cls(ids, lat, lon, cell, int(ids.max()) if len(ids) else 0, table)
+        rg.changes_seq = changes_seq
+        order = np.argsort(rg.cells, kind="stable")
+        rg.ids, rg.lat, rg.lon = ids[order], lat[order], lon[order]
+        rg.cells = rg.cells[order]
+        logging.info(f"Built reverse geocoding index of {len(ids)} points")
+        return rg
+
+    def update(self, db: SQLiteDB, rebuild_fraction: float = 0.1) -> int:
+        """
+        Index the rows added to the table since the last build/update,
+        and remove the rows deleted or changed (read back from
+        `<table>_rg_changes`, changed rows are indexed again).
+        They are kept in a small unsorted delta, and the whole index is rebuilt
+        once the delta grows past `rebuild_fraction` of the index.
+        Return the number of rows read from the table
+        (all of them if the index was rebuilt).
+        """
+        changed = self._changed_ids(db)
+        if changed is None:
+            logging.info("Changes to the table were not tracked, "
+                         "rebuilding the index")
+            fresh = self.build(db, self.table, self.cell)
+            self.__dict__.update(fresh.__dict__)
+            return len(self.ids)
+        nread = 0
+        if len(changed):
+            self._remove(changed)
+            # Updated rows, and rowids reused by new rows
+            ids, lat, lon = self._read_ids(db, self.table,
+                                           changed[changed <= self.max_id])
+            self._add_delta(ids, lat, lon)
+            nread += len(ids)
+        ids, lat, lon = self._read(db, self.table, self.max_id)
+        if len(ids):
+            self._add_delta(ids, lat, lon)
+            self.max_id = max(self.max_id, int(ids.max()))
+            nread += len(ids)
+        if len(self.delta_ids) > rebuild_fraction * max(1, len(self.ids)):
+            self._merge_delta()
+        return nread
+
+    def _changed_ids(self, db: SQLiteDB) -> Optional[np.ndarray]:
+        """
+        Ids of the rows deleted or changed since the last build/update,
+        None if they weren't tracked
+        """
+        if self.changes_seq is None:
+            return None
+        query = f"""
+        SELECT seq, row_id FROM {self.table}_rg_changes WHERE seq > ? ORDER BY seq
+        """
+        try:
+            rows = db.con.cursor().execute(query, [self.changes_seq]).fetchall()
+        except sqlite3.OperationalError:
+            # The changes table was never created
+            return None
+        if rows:
+            self.changes_seq = rows[-1]["seq"]
+        return np.unique(np.asarray([row["row_id"] for row in rows], dtype=np.int64))
+
+    def _remove(self, ids: np.ndarray) -> None:
+        keep = ~np.isin(self.ids, ids)
+        if not keep.all():
+            self.ids, self.lat, self.lon = \
+                self.ids[keep], self.lat[keep], self.lon[keep]
+            self.cells = self.cells[keep]
+        keep = ~np.isin(self.delta_ids, ids)
+        self.delta_ids = self.delta_ids[keep]
+        self.delta_lat = self.delta_lat[keep]
+        self.delta_lon = self.delta_lon[keep]
+
+    def _add_delta(self, ids: np.ndarray, lat: np.ndarray, lon: np.ndarray) -> None:
+        self.delta_ids = np.concatenate([self.delta_ids, ids])
+        self.delta_lat = np.concatenate([self.delta_lat, lat])
+        self.delta_lon = np.concatenate([self.delta_lon, lon])
+
+    def _merge_delta(self) -> None:
+        ids = np.concatenate([self.ids, self.delta_ids])
+        lat = np.concatenate([self.lat, self.delta_lat])
+        lon = np.concatenate([self.lon, self.delta_lon])
+        cells = self._cells(lat, lon)
+        order = np.argsort(cells, kind="stable")
+        self.ids, self.lat, self.lon = ids[order], lat[order], lon[order]
+        self.cells = cells[order]
+        self.delta_ids = self.delta_ids[:0]
+        self.delta_lat = self.delta_lat[:0]
+        self.delta_lon = self.delta_lon[:0]
+
+    @staticmethod
+    def _haversine(
+        lat: float, lon: float, lats: np.ndarray, lons: np.ndarray
+    ) -> np.ndarray:
+        lat, lon = math.radians(lat), math.radians(lon)
+        lats, lons = np.radians(lats), np.radians(lons)
+        a = np.sin((lats - lat) / 2) ** 2 + \
+            math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+        return 2 * EARTH_RADIUS * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+    def _ring_indexes(self, row: int, col: int, r: int) -> np.ndarray:
+        """
+        Indexes into the sorted arrays of the points in the cells
+        at Chebyshev distance r from (row, col).
+        Columns wrap around the antimeridian.
+        """
+        if 2 * r + 1 >= self.ncols:
+            span = np.arange(self.ncols)
+        else:
+            span = np.arange(col - r, col + r + 1) % self.ncols
+        cells = list()
+        # Top and bottom rows of the ring
+        for rr in sorted({row - r, row + r}):
+            if 0 <= rr < self.nrows:
+                cells.append(rr * self.ncols + span)
+        # Left and right columns, unless they were already closer
+        if 0 < r and 2 * r <= self.ncols:
+            rows = np.arange(max(0, row - r + 1), min(self.nrows, row + r))
+            for cc in sorted({(col - r) % self.ncols, (col + r) % self.ncols}):
+                cells.append(rows * self.ncols + cc)
+        cells = np.concatenate(cells) if cells else np.empty(0, dtype=np.int64)
+        starts = np.searchsorted(self.cells, cells, side="left")
+        lengths = np.searchsorted(self.cells, cells, side="right") - starts
+        # Concatenate the ranges [start, start + length)
+        offsets = np.cumsum(lengths) - lengths
+        return np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+
+    def _ring_bound(self, lat: float, row: int, r: int) -> float:
+        """
+        Lower bound of the distance from a point at latitude `lat` in grid row
+        `row` to the points outside the cells within Chebyshev distance r:
+        either their latitude or their longitude differs by more than r cells
+        """
+        bound = math.inf
+        d = math.radians(r * self.cell)
+        if row - r > 0 or row + r < self.nrows - 1:
+            bound = EARTH_RADIUS * d
+        if 2 * r + 1 < self.ncols:
+            # If cell doesn't divide 360, the last column is narrower
+            seam = self.ncols * self.cell - 360
+            d_lon = math.radians(max(0.0, r * self.cell - seam))
+            edge_lat = min(90.0, abs(lat) + (r + 1) * self.cell)
+            cos_lat = math.sqrt(math.cos(math.radians(lat)) *
+                                max(0.0, math.cos(math.radians(edge_lat))))
+            bound = min(bound, 2 * EARTH_RADIUS *
+                        math.asin(min(1.0, cos_lat * math.sin(d_lon / 2))))
+        return bound
+
+    def _cells_within(self, row: int, r: int) -> int:
+        """
+        Number of cells within Chebyshev distance r of a cell in grid row `row`
+        """
+        rows = min(self.nrows - 1, row + r) - max(0, row - r) + 1
+        return rows * min(self.ncols, 2 * r + 1)
+
+    def query(self, lat: float, lon: float, k: int = 1) -> list[tuple[int, float]]:
+        """
+        The k indexed points nearest to (lat, lon).
+        Walks the rings of cells around the point until no point outside
+        them can be nearer, and computes the distance of every point instead
+        when the walk would look at more than a quarter as many cells
+        as there are points (e.g. far from all the points, or near the poles
+        where all the columns are near).
+        :return: (id, distance in km) tuples, nearest first
+        """
+        if not len(self.ids) and not len(self.delta_ids):
+            return []
+        row, col = self._rowcol(lat, lon)
+        row, col = int(row), int(col)
+        # Looking up a cell costs about as much as the distances of 4 points
+        max_cells = len(self.ids) // 4
+        ids = self.delta_ids
+        dist = self._haversine(lat, lon, self.delta_lat, self.delta_lon)
+        r = 0
+        while True:
+            if self._cells_within(row, r) > max_cells:
+                ids = np.concatenate([self.delta_ids, self.ids])
+                dist = np.concatenate([
+                    self._haversine(lat, lon, self.delta_lat, self.delta_lon),
+                    self._haversine(lat, lon, self.lat, self.lon),
+                ])
+                if len(dist) > k:
+                    best = np.argpartition(dist, k - 1)[:k]
+                    ids, dist = ids[best], dist[best]
+                break
+            idx = self._ring_indexes(row, col, r)
+            if len(idx):
+                ids = np.concatenate([ids, self.ids[idx]])
+                dist = np.concatenate(
+                    [dist, self._haversine(lat, lon, self.lat[idx], self.lon[idx])]
+                )
+            # Only the k nearest so far are needed
+            if len(dist) > k:
+                best = np.argpartition(dist, k - 1)[:k]
+                ids, dist = ids[best], dist[best]
+            if self._ring_bound(lat, row, r) == math.inf:
+                break
+            if len(dist) >= k:
+                # The ring guaranteeing the current k-th nearest
+                kth = dist.max()
+                needed = r
+                while self._ring_bound(lat, row, needed) < kth and \
+                        self._cells_within(row, needed) <= max_cells:
+                    needed += 1
+                if needed == r:
+                    break
+                if self._cells_within(row, needed) > max_cells:
+                    # Too far: the next iteration looks at every point
+                    r = needed
+                    continue
+            r += 1
+        order = np.argsort(dist, kind="stable")[:k]
+        return [(int(ids[i]), float(dist[i])) for i in order]
+
+    def label(self, db: SQLiteDB, lat: float, lon: float) -> Optional[dict]:
+        """
+        The cached result nearest to (lat, lon), with its display_name.
+        Indexed ids that no longer exist in the table, or whose coordinates
+        changed (SQLite reuses the largest rowid after a delete),
+        are skipped in favor of the next nearest.
+        """
+        total = len(self.ids) + len(self.delta_ids)
+        checked = 0
+        k = 1
+        while checked < total:
+            res = self.query(lat, lon, k=k)[checked:]
+            checked += len(res)
+            if not res:
+                break
+            phs = ",".join(["?"] * len(res))
+            query = f"""
+            SELECT id, display_name, lat, lon FROM {self.table} WHERE id IN ({phs})
+            """
+            rows = {row["id"]: row for row in
+                    db.con.cursor().execute(query, [i for i, _ in res])}
+            for geocoding_id, distance in res:
+                row = rows.get(geocoding_id)
+                if row is None or row["lat"] is None or row["lon"] is None:
+                    continue
+                actual = float(self._haversine(lat, lon, np.array([row["lat"]]),
+                                               np.array([row["lon"]]))[0])
+                if not math.isclose(actual, distance, abs_tol=1e-6):
+                    continue
+                row = dict(row)
+                row["distance"] = distance
+                return row
+            k *= 2
+        return None
+
+    def save(self, dp: Path | str) -> None:
+        """
+        Save the index to directory `dp` (the delta is merged first).
+        Every file is written to a temporary file and then renamed over the
+        old one, so an index loaded memory-mapped from `dp` can be saved back
+        """
+        if len(self.delta_ids):
+            self._merge_delta()
+        dp = Path(dp)
+        dp.mkdir(parents=True, exist_ok=True)
+        for name in ["ids", "lat", "lon", "cells"]:
+            tmp = dp / f"{name}.npy.tmp"
+            with open(tmp, "wb") as fh:
+                np.save(fh, getattr(self, name))
+            os.replace(tmp, dp / f"{name}.npy")
+        meta = {"cell": self.cell, "max_id": self.max_id, "table": self.table,
+                "changes_seq": self.changes_seq}
+        tmp = dp / "meta.json.tmp"
+        with open(tmp, "w") as fh:
+            json.dump(meta, fh)
+        os.replace(tmp, dp / "meta.json")
+
+    @classmethod
+    def load(cls, dp: Path | str, mmap: bool = True) -> "ReverseGeocoder":
+        """
+        Load an index saved with save(). With mmap=True the arrays are
+        memory-mapped, so loading is instant and pages are read on demand.
+        """
+        dp = Path(dp)
+        with open(dp / "meta.json") as fh:
+            meta = json.load(fh)
+        mode = "r" if mmap else None
+        rg = cls.__new__(cls)
+        rg.cell = meta["cell"]
+        rg.max_id = meta["max_id"]
+        rg.table = meta["table"]
+        rg.changes_seq = meta.get("changes_seq")
+        rg.nrows = int(math.ceil(180 / rg.cell))
+        rg.ncols = int(math.ceil(360 / rg.cell))
+        rg.ids = np.load(dp / "ids.npy", mmap_mode=mode)
+        rg.lat = np.load(dp / "lat.npy", mmap_mode=mode)
+        rg.lon = np.load(dp / "lon.npy", mmap_mode=mode)
+        rg.cells = np.load(dp / "cells.npy", mmap_mode=mode)
+        rg.delta_ids = np.empty(0, dtype=np.int64)
+        rg.delta_lat = np.empty(0, dtype=np.float64)
+        rg.delta_lon = np.empty(0, dtype=np.float64)
+        return rg